@@ -21,8 +21,13 @@ def parse_arguments():
     parser.add_argument("--use_sglang", action="store_true", help="whether to use sglang engine")
     parser.add_argument("--use_vllm_serving", action="store_true", help="whether to use vllm serving engine")
     parser.add_argument("--use_tgi_serving", action="store_true", help="whether to use tgi serving engine")
-    parser.add_argument("--endpoint_url", type=str,default="http://localhost:8080/v1/", help="endpoint url for tgi or vllm serving engine")
+    parser.add_argument("--endpoint_url", type=str,default="http://localhost:8080/v1/", help="endpoint url for tgi or vllm serving engine, multiple replicas can be separated by comma and the requests will be balanced across them")
+    parser.add_argument("--use_async", action="store_true", help="for the OpenAI-compatible (including tgi/vllm serving) and Anthropic APIs, run the requests on one event loop with the async clients instead of a thread per request, for OpenAI and Anthropic this also replaces the default batch API")
+    parser.add_argument("--stream", action="store_true", help="for the OpenAI-compatible APIs (including tgi/vllm serving), stream the outputs to measure the time to first token")
+    parser.add_argument("--max_concurrency", type=int, default=256, help="maximum number of in-flight requests when using --use_async")
+    parser.add_argument("--balance_by", type=str, default="requests", choices=["requests", "tokens"], help="with multiple endpoints, route each request to the replica with the fewest outstanding requests or tokens")
     parser.add_argument("--api_key", type=str, default="EMPTY", help="api key for model endpoint")
+    parser.add_argument("--shared_pool", action="store_true", help="for the serving engines, submit the requests of all datasets to one shared pool of MAX_WORKERS (env var) concurrent requests instead of running the datasets one at a time")
 
     # data settings
     parser.add_argument("--datasets", type=str, default=None, help="comma separated list of dataset names")
@@ -32,9 +37,17 @@ def parse_arguments():
     parser.add_argument("--overwrite", action="store_true", help="whether to the saved file")
     parser.add_argument("--max_test_samples", type=int, default=None)
     parser.add_argument("--num_workers", type=int, default=4, help="number of workers for data loading")
+    parser.add_argument("--prepare_chunk_size", type=int, default=16, help="number of consecutive samples that each worker prepares at once, the tokenization is batched within a chunk")
+    parser.add_argument("--cache_data", action="store_true", help="cache the prepared samples of each dataset on disk (in arrow), keyed by the data files, shots, seed, and max_test_samples, so that the runs with other models or generation settings skip the preprocessing")
+    parser.add_argument("--data_cache_dir", type=str, default=None, help="directory of the data cache, defaults to $HELMET_CACHE_DIR/data or ~/.cache/helmet/data")
+    parser.add_argument("--data_cache_max_gb", type=float, default=50, help="evict the least recently used datasets when the data cache is larger than this")
+    parser.add_argument("--data_cache_max_days", type=float, default=30, help="evict the datasets that were not used for this many days")
+    parser.add_argument("--token_index_max_gb", type=float, default=20, help="evict the least recently used token offset indices (see token_index.py) when they take more than this")
+    parser.add_argument("--token_index_max_days", type=float, default=30, help="evict the token offset indices that were not used for this many days")
 
     # dataset specific settings
     parser.add_argument("--popularity_threshold", type=int, default=3, help="popularity threshold for popqa, in log scale")
+    parser.add_argument("--legacy_demo_sampling", action="store_true", help="for the QA datasets (nq, triviaqa, hotpotqa, popqa), shuffle the whole demo set for each sample as in the earlier versions, which reproduces their demos exactly but is much slower")
 
     # evaluation settings
     parser.add_argument("--shots", type=int, default=2, help="total number of ICL demos")
@@ -45,6 +58,7 @@ def parse_arguments():
     parser.add_argument("--do_sample", type=ast.literal_eval, choices=[True, False], default=False, help="whether to use sampling (false is greedy), overwrites temperature")
     parser.add_argument("--generation_max_length", type=str, default='10', help="max number of tokens to generate, can be separated by comma to match the specified datasets")
     parser.add_argument("--generation_min_length", type=int, default=0, help="min number of tokens to generate")
+    parser.add_argument("--ordering", type=str, default="original", choices=["original", "longest_first", "bucketed", "prefix"], help="the order in which the requests are submitted for generation (by input length, or prefix to group the inputs sharing a prefix for the prefix caches of vllm/sglang), the outputs are always saved in the original order")
     parser.add_argument("--temperature", type=float, default=0.0, help="generation temperature")
     parser.add_argument("--top_p", type=float, default=1.0, help="top-p parameter for nucleus sampling")
     parser.add_argument("--stop_new_line", type=ast.literal_eval, choices=[True, False], default=False, help="whether to stop generation at newline")
@@ -57,6 +71,12 @@ def parse_arguments():
     parser.add_argument("--no_torch_compile", action="store_true", help="disable torchcompile")
     parser.add_argument("--use_chat_template", type=ast.literal_eval, choices=[True, False], default=False, help="whether to use chat template")
     parser.add_argument("--rope_theta", type=int, default=None, help="override rope theta")
+    parser.add_argument("--prefill_chunk_size", type=int, default=None, help="for HF models, prefill the input in chunks of this many tokens to lower the peak memory at long context (the peak is reported in the telemetry), by default the whole input is prefilled at once")
+    parser.add_argument("--prefix_cache_gb", type=float, default=None, help="for HF models, keep the kv caches of the previous inputs up to this many GB and reuse them for the inputs that share a prefix (e.g., several questions about the same document, best with --ordering prefix), disabled by default")
+    parser.add_argument("--score_candidates", action="store_true", help="for the tasks with a finite label set (icl and infbench choice), score every label by its log-likelihood instead of generating (HF models only, the other models generate), the outputs are post-processed the same way")
+    parser.add_argument("--batch_tokens", type=int, default=None, help="for HF models, batch the inputs of similar lengths such that batch size x (padded input length + generation_max_length) fits this token budget, by default the inputs are generated one at a time")
+    parser.add_argument("--continuous_batching", type=int, default=None, help="for HF models, decode up to this many sequences together and admit a new input as soon as one stops, takes precedence over --batch_tokens (the model runs uncompiled in this mode, the prompts are admitted in chunks of --prefill_chunk_size tokens)")
+    parser.add_argument("--max_batch_size", type=int, default=32, help="the maximum batch size with --batch_tokens")
     parser.add_argument("--thinking", action="store_true", help="for reasoning models (e.g., Deepseek-r1), when this is set, we allow the model to generate an additional 32k tokens and exclude all texts between <think>*</think> from the output for evaluation")
 
     # misc
@@ -1,18 +1,27 @@
+import os
 import json
 import copy
+import shutil
 import math
 import random
 import numpy as np
 import hashlib
+import functools
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from typing import Dict, List, Tuple, Any
 
 import datasets
 from datasets import load_dataset, load_from_disk
+import torch
 from torch.utils.data import Dataset
-from transformers import AutoTokenizer
+from transformers import AutoTokenizer, BatchEncoding
+from tqdm import tqdm
 
 import re
 from utils import calculate_metrics, parse_output, parse_rankings, calculate_retrieval_metrics
+from token_index import build_token_offsets, load_offsets, evict_entries
 
 import logging
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
@@ -20,6 +29,8 @@ logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s - %(message)s
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+CACHE_DIR = os.getenv("HELMET_CACHE_DIR", os.path.expanduser("~/.cache/helmet"))
+
 
 def filter_contexts(data):
     # filter the contexts and only keep the ones that contain the answer
@@ -34,21 +45,39 @@ def filter_contexts(data):
     return new_data
 
 
-def drop_duplicates(data, key="id"):
+def get_unique_indices(data, key="id"):
+    # the indices of the first occurrence of each key, only reading the key column
     indices_to_keep = []
     keys = set()
-    for i, d in enumerate(data):
-        if d[key] in keys:
+    for i, k in enumerate(data[key]):
+        if k in keys:
             continue
         indices_to_keep.append(i)
-        keys.add(d[key])
-    data = data.select(indices_to_keep)
-    return data
+        keys.add(k)
+    return indices_to_keep
+
+
+def drop_duplicates(data, key="id"):
+    return data.select(get_unique_indices(data, key))
+
+
+def sample_demos(demo_data, demo_indices, key, seed, shots, exclude=None):
+    """
+    Draw the demos from the deduplicated demo indices (see get_unique_indices) with a fixed seed.
+    random.sample only touches shots+1 positions, so this is O(shots) per sample instead of shuffling the whole demo set.
+    One extra demo is drawn in case it has the excluded key (e.g., the test question itself for popqa).
+    """
+    rng = random.Random(seed)
+    positions = rng.sample(range(len(demo_indices)), min(shots + 1, len(demo_indices)))
+    demos = [demo_data[demo_indices[p]] for p in positions]
+    return [d for d in demos if exclude is None or d[key] != exclude][:shots]
 
 
-def load_qa(dataset, path, demo_path, max_test_samples=None, popularity_threshold=None, shots=0):
+def load_qa(dataset, path, demo_path, max_test_samples=None, popularity_threshold=None, shots=0, legacy_demo_sampling=False):
     """
     Load the data for QA tasks
+    legacy_demo_sampling: shuffle and deduplicate the whole demo set for each sample, which reproduces the demos of the earlier results but is much slower;
+    by default, the demos are drawn from a deduplicated index built once (see sample_demos), which gives different (but also deterministic) demos.
     """
     if "nq_bad" in dataset:
         user_template = "Use the given documents to write a concise and short answer to the question. Only use the information presented in the documents, and output 'unanswerable' if the question is not valid or cannot be answered with the given document. Write your answer in the following format:\nAnswer: [answer]\n\n{demos}{context}\n\nQuestion: {question}"
@@ -89,19 +118,25 @@ def load_qa(dataset, path, demo_path, max_test_samples=None, popularity_threshol
     # demo_template = "Document (Title: {gold_title}): {gold_doc}\n\nQuestion: {question}\nAnswer: {answer}"
     demo_template = "{documents}\n\nQuestion: {question}\nAnswer: {answer}"
     passage_template = "Document (Title: {title}): {text}"
+    if shots > 0 and not legacy_demo_sampling:
+        demo_indices = get_unique_indices(demo_data, key)
+
     def update(sample):
         demos = demo_data
         demo_text = ""
         if shots > 0:
-            if 'popqa' in dataset:
-                # popqa only has one split
-                demos = demo_data.filter(lambda x: x[key] != sample[key])
-
             # seed ensures that we get the same demos for the same question
             # hashlib is deterministic while hash() is not in Python>=3.3, the seed has to be a positive integer
             h = int(hashlib.sha256(str(sample[key]).encode("utf-8")).hexdigest(), 16) % 2**31
-            demos = demos.shuffle(seed=h)
-            demos = drop_duplicates(demos, key).select(range(shots))
+            if not legacy_demo_sampling:
+                # popqa only has one split, so we exclude the question itself
+                demos = sample_demos(demo_data, demo_indices, key, h, shots, exclude=sample[key] if 'popqa' in dataset else None)
+            else:
+                if 'popqa' in dataset:
+                    # popqa only has one split
+                    demos = demo_data.filter(lambda x: x[key] != sample[key])
+                demos = demos.shuffle(seed=h)
+                demos = drop_duplicates(demos, key).select(range(shots))
             demo_text = "\n\n".join([demo_template.format(**d, documents="\n\n".join([passage_template.format(**c) for c in d["ctxs"]]), answer=d["answers"][0]) for d in demos]) + "\n\n"
         passage_text = ""
         if len(sample['ctxs']) > 0:
@@ -159,26 +194,49 @@ def load_json_kv(path, shots, max_test_samples=None, seed=42):
     }
 
 
-def truncate_llama2(dataset, data, postfix_text=" ... [the rest of the text is omitted]"):
-    # use the llama 2 tokenizer to truncate to max_length, which only applies to the main document (context) and exclude the instructions and the demos
-    # this is to make sure that every model see the same amount of information
-    max_length = int(dataset.split("_")[-1])
-    tokenizer = AutoTokenizer.from_pretrained("meta-llama/Llama-2-7b-hf")
+LLAMA2_TOKENIZER = "meta-llama/Llama-2-7b-hf"
+
+
+@functools.lru_cache(maxsize=None)
+def get_llama2_tokenizer():
+    return AutoTokenizer.from_pretrained(LLAMA2_TOKENIZER)
+
+
+def get_llama2_truncation(texts, max_length, postfix_text=" ... [the rest of the text is omitted]"):
+    """
+    Get the length of each text with the llama 2 tokenizer, and the character position to truncate it at
+    (None if it fits in max_length), the truncated text is text[:cut] + postfix_text.
+    The token offsets are indexed on disk (see token_index.py), so each document is tokenized once for all the lengths and the later runs.
+    """
+    tokenizer = get_llama2_tokenizer()
     separator_length = len(tokenizer(postfix_text)["input_ids"])
+    lengths, cuts = [], []
+    for path in build_token_offsets(tokenizer, texts):
+        offsets = load_offsets(path)
+        lengths.append(len(offsets))
+        cuts.append(int(offsets[max_length-separator_length][1]) if len(offsets) > max_length else None)
+    return lengths, cuts
 
-    def truncate(sample):
-        tokens = tokenizer(sample["context"], return_offsets_mapping=True)
-        if len(tokens["input_ids"]) > max_length:
-            # truncate
-            sample["context"] = sample["context"][:tokens["offset_mapping"][max_length-separator_length][1]] + postfix_text
-        return sample
-    return data.map(truncate, num_proc=16)
 
+def apply_truncation(data, cuts, key="context", postfix_text=" ... [the rest of the text is omitted]"):
+    def truncate(text, idx):
+        if cuts[idx] is None:
+            return {key: text}
+        return {key: text[:cuts[idx]] + postfix_text}
+    return data.map(truncate, input_columns=key, with_indices=True)
 
-def filter_length(data, min_length, key):
-    tokenizer = AutoTokenizer.from_pretrained("meta-llama/Llama-2-7b-hf")
-    data = data.filter(lambda x: len(tokenizer(x[key])['input_ids']) >= min_length, num_proc=32)
-    return data
+
+def filter_and_truncate_llama2(dataset, data, min_length, key="context"):
+    """
+    Keep the samples with at least min_length tokens and truncate them to max_length (the suffix of the dataset name) with the llama 2 tokenizer,
+    which only applies to the main document (context) and exclude the instructions and the demos
+    this is to make sure that every model see the same amount of information
+    """
+    max_length = int(dataset.split("_")[-1])
+    lengths, cuts = get_llama2_truncation(data[key], max_length)
+    keep = [i for i, length in enumerate(lengths) if length >= min_length]
+    data = data.select(keep)
+    return apply_truncation(data, [cuts[i] for i in keep], key)
 
 
 def load_narrativeqa(dataset, shots=0, max_samples=None, seed=42):
@@ -189,11 +247,19 @@ def load_narrativeqa(dataset, shots=0, max_samples=None, seed=42):
     all_data = load_dataset("narrativeqa")
     data = all_data["test"].shuffle(seed=seed)
     
-    # filter for a specific length
-    tokenizer = AutoTokenizer.from_pretrained("meta-llama/Llama-2-7b-hf")
-    data = data.map(lambda x: {'input_length': len(tokenizer(x['document']['text'])['input_ids'])})
-    data = data.filter(lambda x: x['input_length'] > 131072) # this should yield 1330 samples
-    data = data.remove_columns("input_length")
+    # filter for a specific length, the documents are tokenized once for both the filtering and the truncation
+    # many questions share a document, so only the unique documents are loaded (the full column is several GB)
+    doc_ids = data.select_columns("document").flatten()["document.id"]
+    first_row = {}
+    for i, doc_id in enumerate(doc_ids):
+        first_row.setdefault(doc_id, i)
+    unique_texts = [d["text"] for d in data.select(list(first_row.values())).select_columns("document")["document"]]
+    doc_lengths, doc_cuts = get_llama2_truncation(unique_texts, int(dataset.split("_")[-1]))
+    doc_index = {doc_id: j for j, doc_id in enumerate(first_row)}
+    lengths = [doc_lengths[doc_index[doc_id]] for doc_id in doc_ids]
+    cuts = [doc_cuts[doc_index[doc_id]] for doc_id in doc_ids]
+    keep = [i for i, length in enumerate(lengths) if length > 131072] # this should yield 1330 samples
+    data = data.select(keep)
     
     data = data.map(lambda example: {
         "context": example["document"]["text"],
@@ -202,8 +268,7 @@ def load_narrativeqa(dataset, shots=0, max_samples=None, seed=42):
         "demo": "" if shots == 0 else "For example:\n\n" + "\n\n".join([f"Question: {ex['question']['text']}\nAnswer: {ex['answers'][0]['text']}" for ex in all_data["train"].shuffle().select(range(shots))]) + "\n\nNow, use the following story to answer the question:\n\n"
     }, remove_columns=["document", "answers"])
 
-    data = filter_length(data, 131072, "context")
-    data = truncate_llama2(dataset, data)
+    data = apply_truncation(data, [cuts[i] for i in keep])
     if max_samples is not None:
         data = data.select(range(min(max_samples, len(data))))
 
@@ -232,8 +297,7 @@ def load_multi_lexsum(dataset, shots=0, max_samples=None, seed=42):
     })
 
     test_data = all_data["validation"]
-    test_data = filter_length(test_data, 65536, "context")
-    test_data = truncate_llama2(dataset, test_data)
+    test_data = filter_and_truncate_llama2(dataset, test_data, 65536)
 
     if max_samples is not None and len(test_data) > max_samples:
         test_data = test_data.shuffle(seed=seed).select(range(max_samples))
@@ -258,7 +322,7 @@ def load_multi_lexsum(dataset, shots=0, max_samples=None, seed=42):
     }
 
 
-def load_msmarco_rerank(path, demo_path=None, max_test_samples=None, shots=0, seed=42):
+def load_msmarco_rerank(path, demo_path=None, max_test_samples=None, shots=0, seed=42, num_proc=None):
     random.seed(seed)
     user_template = "You are provided with a list of documents, each indicated by their ID. Rank each document based on their relevance to the question in descending order from most relelvant to least relevant texts. Include all documents in the rankings. Write your answer using the unique IDs, with the following format:\nRanking: ID3 > ID1 > ID2\n\n{demos}{context}\n\nQuery: {question}"
     system_template = "Ranking:"
@@ -289,7 +353,19 @@ def load_msmarco_rerank(path, demo_path=None, max_test_samples=None, shots=0, se
         demos = demos.filter(lambda x: x["qid"] not in qids)
         demo_filtered = True
 
-    def update(sample, demos):
+    # the demo pool is processed once: the qids are kept in an array to select the candidates of each sample,
+    # and the rendered block (passages, query, and gold ranking) of each demo is cached the first time it is drawn
+    demo_qids = np.array(demos["qid"])
+    demo_blocks = {}
+    def get_demo_block(idx, passage_template):
+        if (idx, passage_template) not in demo_blocks:
+            d = demos[idx]
+            # sort ids by label
+            ranking = " > ".join([x['id'] for x in sorted(d["ctxs"], key=lambda x: x["label"], reverse=True)])
+            demo_blocks[(idx, passage_template)] = "\n\n".join([passage_template.format(**c) for c in d['ctxs']]) + f"\n\nQuery: {d['query']}\nRanking: {ranking}" + "\n\n"
+        return demo_blocks[(idx, passage_template)]
+
+    def update(sample):
         passage_text = ""
 
         passage_template = "[ID: {id}] Document (Title: {title}): {text}"  if "title" in sample["ctxs"][0] else "[ID: {id}] Document: {text}"
@@ -299,27 +375,26 @@ def load_msmarco_rerank(path, demo_path=None, max_test_samples=None, shots=0, se
 
         if shots > 0:
             # need to make sure we don't pick the same question as the demos
-            if not demo_filtered:
-                demos = demos.filter(lambda x: x["qid"] != sample["qid"])
+            candidates = np.arange(len(demo_qids)) if demo_filtered else np.flatnonzero(demo_qids != sample["qid"])
             # hashlib is deterministic while hash() is not in Python>=3.3, the seed has to be a positive integer
             h = abs(int(hashlib.sha256(sample["qid"].encode("utf-8")).hexdigest(), 16) % 2**31)
-            demo = demos.shuffle(seed=h)
-            demo = drop_duplicates(demo, 'qid').select(range(shots))
+            # this is the same permutation as datasets.Dataset.shuffle(seed=h), so the demos are the same as shuffling the demo set
+            order = candidates[np.random.default_rng(h).permutation(len(candidates))]
 
             demo_ids = set()
-            for d in demo:
-                if d["qid"] in demo_ids or len(demo_ids) >= shots:
+            for idx in order:
+                if len(demo_ids) >= shots:
+                    break
+                if demo_qids[idx] in demo_ids:
                     continue
-                demo_ids.add(d["qid"])
-                # sort ids by label
-                ids = sorted(d["ctxs"], key=lambda x: x["label"], reverse=True)
-                ranking = " > ".join([x['id'] for x in ids])
-                demo_text += "\n\n".join([passage_template.format(**c) for c in d['ctxs']]) + f"\n\nQuery: {d['query']}\nRanking: {ranking}" + "\n\n"
+                demo_ids.add(demo_qids[idx])
+                demo_text += get_demo_block(int(idx), passage_template)
 
         qrel = [[c['id'], str(c['label'])] for c in sample["ctxs"]]
         return {"context": passage_text, "question": sample["query"], "demos": demo_text, "answer": gold_ranking, "qrel": qrel}
 
-    data = data.map(lambda x: update(x, demos), remove_columns=["query", "ctxs"])
+    # each query carries its passages and the demo search, so the processes pay off even for the ~100 queries of the rerank configs
+    data = data.map(update, remove_columns=["query", "ctxs"], num_proc=min(num_proc, len(data)) if num_proc is not None and num_proc > 1 and len(data) > 1 else None)
 
     def post_process(output, example):
         parsed_pred = parse_rankings(output["output"])
@@ -463,6 +538,8 @@ def load_icl(dataset, max_test_sample=None, seed=42):
         "user_template": user_template,
         "system_template": system_template,
         "post_process": post_process,
+        # the finite label set, for scoring the labels instead of generating (see --score_candidates)
+        "candidates": [str(id2label[i]) for i in range(num_labels)] if "natural_label" in dataset else [str(i) for i in range(num_labels)],
     }
 
 
@@ -617,8 +694,7 @@ def load_infbench(dataset, shots=0, max_test_samples=None, seed=42):
         return update
     data = data.map(process_example)
 
-    def add_demos(example):
-        demos = data.filter(lambda x: x["id"] != example["id"]).shuffle(seed=seed).select(range(shots))
+    def format_demos(demos):
         if "qa_eng" in dataset:
             temp = "[story text]\nQuestion: {question}\nAnswer: {answer[0]}"
             demo = "\n\n".join([temp.format(**x) for x in demos])
@@ -627,24 +703,36 @@ def load_infbench(dataset, shots=0, max_test_samples=None, seed=42):
             demo = "\n\n".join([temp.format(**x) for x in demos])
         elif "sum_eng" in dataset:
             demo = "\n\n".join([f"[story text]\nSummary: {x['answer'][0].strip()}" for x in demos])
-        return {"demo": f"For example:\n\n{demo}\n\nNow, read the following story:\n\n"}
+        return f"For example:\n\n{demo}\n\nNow, read the following story:\n\n"
     if shots > 0:
-        data = data.map(add_demos)
+        # the demos are picked from a view without the book texts, and the demo column is added without rewriting the contexts
+        demo_view = data.select_columns(["id", "question", "answer"] + (["options"] if "choice_eng" in dataset else []))
+        rows = demo_view.to_list()
+        ids = np.array(demo_view["id"])
+        all_demos = []
+        for example_id in ids:
+            # the same as data.filter(lambda x: x["id"] != example_id).shuffle(seed=seed).select(range(shots)), since Dataset.shuffle uses np.random.default_rng(seed).permutation
+            candidates = np.flatnonzero(ids != example_id)
+            picked = candidates[np.random.default_rng(seed).permutation(len(candidates))][:shots]
+            all_demos.append(format_demos([rows[i] for i in picked]))
+        data = data.remove_columns("demo").add_column("demo", all_demos)
 
     # all samples are already longer than 65536 tokens, but this is just a sanity step
-    data = filter_length(data, 65536, "context") 
-    data = truncate_llama2(dataset, data)
+    data = filter_and_truncate_llama2(dataset, data, 65536)
 
     if max_test_samples is not None:
         data = data.shuffle(seed=seed).select(range(min(len(data), max_test_samples)))
 
-    return {
+    output = {
         "data": data,
         "prompt_template": prompt_template,
         "user_template": user_template,
         "system_template": system_template,
         "post_process": post_process,
     }
+    if "choice_eng" in dataset:
+        output["candidates"] = ["A", "B", "C", "D"]
+    return output
 
 
 def default_post_process(output, example):
@@ -662,12 +750,137 @@ def default_post_process(output, example):
     return mets, {"parsed_output": parsed_pred}
 
 
+DATA_CACHE_DIR = os.path.join(CACHE_DIR, "data")
+
+
+def get_file_signature(path):
+    # the size and modification time are much cheaper than hashing the (often multi-GB) data files
+    if path is None or not os.path.exists(path):
+        return path
+    stat = os.stat(path)
+    return f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def get_source_hash(paths):
+    h = hashlib.sha256()
+    for path in sorted(paths):
+        with open(path, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def get_loader_sources():
+    # the loaders in this file, the token index used for the truncation, and the longproc loaders (including the longproc package)
+    root = os.path.dirname(os.path.abspath(__file__))
+    paths = [os.path.join(root, "data.py"), os.path.join(root, "token_index.py")]
+    for dirpath, _, filenames in os.walk(os.path.join(root, "longproc_addon")):
+        paths += [os.path.join(dirpath, f) for f in filenames if f.endswith(".py")]
+    return paths
+
+
+def get_data_cache_key(args, dataset, path=None, demo_path=None):
+    """
+    The key covers everything that changes the output of the loaders, including the code of the loaders (see get_loader_sources) and the tokenizer used for the truncation,
+    but not the model or the generation settings.
+    """
+    import tokenizers
+    import transformers
+    key = {
+        "dataset": dataset,
+        "path": get_file_signature(path),
+        "demo_path": get_file_signature(demo_path),
+        "shots": args.shots,
+        "seed": args.seed,
+        "max_test_samples": args.max_test_samples,
+        "popularity_threshold": getattr(args, "popularity_threshold", None),
+        "legacy_demo_sampling": getattr(args, "legacy_demo_sampling", False),
+        "code": get_source_hash(get_loader_sources()),
+        # the truncation of the long documents depends on the llama 2 tokenizer (see get_llama2_truncation)
+        "truncation_tokenizer": [LLAMA2_TOKENIZER, transformers.__version__, tokenizers.__version__],
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def load_cached_data(cache_dir, key):
+    import dill
+    entry = os.path.join(cache_dir, key)
+    if not os.path.exists(os.path.join(entry, "meta.pkl")):
+        return None
+    try:
+        with open(os.path.join(entry, "meta.pkl"), "rb") as f:
+            data = dill.load(f)
+        # the samples stay memory-mapped, so a cache hit does not read the (multi-GB at 128k) data into memory
+        data["data"] = load_from_disk(os.path.join(entry, "data"))
+    except Exception as e:
+        logger.warning(f"Failed to load the cached data from {entry}: {e}")
+        return None
+    # the modification time marks the last use for the eviction
+    os.utime(entry)
+    return data
+
+
+def save_cached_data(cache_dir, key, data):
+    import dill
+    if not isinstance(data["data"], datasets.Dataset):
+        logger.info("Only the datasets.Dataset outputs are cached, skipping...")
+        return
+    entry = os.path.join(cache_dir, key)
+    tmp_entry = entry + f".tmp{os.getpid()}"
+    try:
+        # the samples are stored in arrow, and the templates and post-processing functions are pickled with dill (a dependency of datasets)
+        data["data"].flatten_indices().save_to_disk(os.path.join(tmp_entry, "data"))
+        with open(os.path.join(tmp_entry, "meta.pkl"), "wb") as f:
+            dill.dump({k: v for k, v in data.items() if k != "data"}, f, recurse=True)
+        os.rename(tmp_entry, entry)
+    except Exception as e:
+        logger.warning(f"Failed to cache the data to {entry}: {e}")
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+
+
+def evict_data_cache(cache_dir, max_size_gb=None, max_age_days=None):
+    """
+    Remove the entries that were not used for max_age_days, and then the least recently used ones until the cache fits in max_size_gb.
+    """
+    if not os.path.exists(cache_dir):
+        return
+    entries = []
+    for name in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, name)
+        if ".tmp" in name or not os.path.isdir(entry):
+            continue
+        size = sum([os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(entry) for f in files])
+        entries.append((os.path.getmtime(entry), size, entry))
+    evict_entries(entries, max_size_gb=max_size_gb, max_age_days=max_age_days, name="data cache")
+
+
 def load_data(args, dataset, path=None, demo_path=None):
+    """
+    Load the data with the dataset specific loader, with --cache_data the prepared samples are cached on disk
+    so that the runs with different models or generation settings skip the preprocessing.
+    """
+    if not getattr(args, "cache_data", False):
+        return load_data_uncached(args, dataset, path, demo_path)
+
+    cache_dir = getattr(args, "data_cache_dir", None) or DATA_CACHE_DIR
+    key = get_data_cache_key(args, dataset, path, demo_path)
+    data = load_cached_data(cache_dir, key)
+    if data is not None:
+        logger.info(f"Loaded {dataset} from the data cache {os.path.join(cache_dir, key)}")
+        return data
+
+    data = load_data_uncached(args, dataset, path, demo_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    save_cached_data(cache_dir, key, data)
+    evict_data_cache(cache_dir, max_size_gb=getattr(args, "data_cache_max_gb", None), max_age_days=getattr(args, "data_cache_max_days", None))
+    return data
+
+
+def load_data_uncached(args, dataset, path=None, demo_path=None):
     if "popqa" in dataset:
         popularity_threshold = float(dataset.split("_")[-1])
-        data = load_qa(dataset, path, demo_path, max_test_samples=args.max_test_samples, popularity_threshold=popularity_threshold, shots=args.shots)
+        data = load_qa(dataset, path, demo_path, max_test_samples=args.max_test_samples, popularity_threshold=popularity_threshold, shots=args.shots, legacy_demo_sampling=getattr(args, "legacy_demo_sampling", False))
     elif any([x in dataset for x in ["nq", "hotpotqa", "triviaqa"]]):
-        data = load_qa(dataset, path, demo_path, max_test_samples=args.max_test_samples, shots=args.shots)
+        data = load_qa(dataset, path, demo_path, max_test_samples=args.max_test_samples, shots=args.shots, legacy_demo_sampling=getattr(args, "legacy_demo_sampling", False))
     elif dataset == "json_kv":
         data = load_json_kv(path, args.shots, args.max_test_samples, args.seed)
     elif dataset == "json_kv_chinese_poem":
@@ -677,7 +890,7 @@ def load_data(args, dataset, path=None, demo_path=None):
     elif "narrativeqa" in dataset:
         data = load_narrativeqa(dataset, args.shots, args.max_test_samples, args.seed)
     elif "msmarco" in dataset:
-        data = load_msmarco_rerank(path, demo_path, args.max_test_samples, args.shots, args.seed)
+        data = load_msmarco_rerank(path, demo_path, args.max_test_samples, args.shots, args.seed, num_proc=getattr(args, "num_workers", None))
     elif "alce" in dataset:
         data = load_alce(dataset, path, demo_path, args.shots)
         if args.max_test_samples is not None:
@@ -700,6 +913,8 @@ def load_data(args, dataset, path=None, demo_path=None):
 
     if "post_process" not in data:
         data["post_process"] = default_post_process
+    # the models use the dataset name to calibrate the length pre-check of the prompts (see model_utils.LengthPrecheck)
+    data["dataset"] = dataset
 
     return data
 
@@ -709,18 +924,129 @@ class TestItemDataset(Dataset):
     data is a dictionary that should contain the "data" field, which is a list of samples
     llm is of type LLM from model_utils
     tokenizer is any callable tokenizer with decode method, but not necessary
+    full_decode: decode the whole input back to text, otherwise only the first and last preview_length tokens are decoded,
+    since the text is only used for logging and decoding 128k tokens costs about as much as tokenizing them
     """
-    def __init__(self, data: Dict[str, Any], llm, tokenizer=None):
+    def __init__(self, data: Dict[str, Any], llm, tokenizer=None, full_decode: bool=False, preview_length: int=500):
         self.data = data
         self.llm = llm
         self.tokenizer = tokenizer
+        self.full_decode = full_decode
+        self.preview_length = preview_length
 
     def __len__(self):
         return len(self.data["data"])
 
+    def get_original_text(self, inputs):
+        if "input_ids" not in inputs:
+            return None
+        input_ids = inputs["input_ids"][0]
+        if self.full_decode or len(input_ids) <= 2 * self.preview_length:
+            return self.tokenizer.decode(input_ids, skip_special_tokens=False)
+        return self.tokenizer.decode(input_ids[:self.preview_length], skip_special_tokens=False) + " <skip> " + self.tokenizer.decode(input_ids[-self.preview_length:], skip_special_tokens=False)
+
+    def get_items(self, start, end):
+        all_inputs = self.llm.prepare_inputs_batch([self.data["data"][idx] for idx in range(start, end)], self.data)
+        return [(inputs, self.get_original_text(inputs)) for inputs in all_inputs]
+
     def __getitem__(self, idx):
-        inputs = self.llm.prepare_inputs(self.data["data"][idx], self.data)
-        original_text = None
-        if "input_ids" in inputs:
-            original_text = self.tokenizer.decode(inputs["input_ids"][0], skip_special_tokens=False)
-        return inputs, original_text
+        return self.get_items(idx, idx+1)[0]
+
+
+# the workers of prepare_all_inputs get the dataset by forking instead of pickling, since the models cannot be pickled
+prepare_context = {}
+
+
+def init_prepare_worker():
+    # the workers already run in parallel, so the Rust tokenizer should not spawn its own threads in each of them
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+
+
+def prepare_chunk(start, end):
+    """
+    Prepare the samples in [start, end) in a worker process.
+    The token ids of all the samples are copied into one int32 shared memory buffer instead of pickling an int64 tensor per sample,
+    the other inputs (e.g., the chat messages of the API models) are pickled as usual.
+    Returns the name of the shared memory (None if no sample has token ids), the number of tokens of each sample, the (inputs, original_text) pairs with the token ids taken out,
+    and the stats of the length pre-check of the API models in this chunk (see model_utils.LengthPrecheck), which stay in the worker otherwise.
+    """
+    items = prepare_context["dataset"].get_items(start, end)
+    precheck = getattr(prepare_context["dataset"].llm, "length_precheck", None)
+    stats = precheck.pop_stats() if precheck is not None else None
+    token_ids, lengths, rest = [], [], []
+    for inputs, original_text in items:
+        # only the plain tokenized inputs are sent through the buffer, the attention mask is all ones and is rebuilt by the main process
+        if isinstance(inputs, BatchEncoding) and set(inputs.keys()) <= {"input_ids", "attention_mask"} and inputs["input_ids"].shape[0] == 1:
+            token_ids.append(inputs["input_ids"][0].numpy().astype(np.int32))
+            lengths.append(len(token_ids[-1]))
+            rest.append((None, original_text))
+        else:
+            lengths.append(None)
+            rest.append((inputs, original_text))
+
+    if len(token_ids) == 0:
+        return None, lengths, rest, stats
+    buffer = np.concatenate(token_ids)
+    shm = shared_memory.SharedMemory(create=True, size=max(buffer.nbytes, 1))
+    np.ndarray(buffer.shape, dtype=np.int32, buffer=shm.buf)[:] = buffer
+    # the main process owns the buffer from now on and unlinks it, otherwise the resource tracker would also unlink it when this worker exits
+    resource_tracker.unregister(shm._name, "shared_memory")
+    shm.close()
+    return shm.name, lengths, rest, stats
+
+
+def read_chunk(shm_name, lengths, rest):
+    if shm_name is None:
+        return rest
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        buffer = np.ndarray((sum([l for l in lengths if l is not None]),), dtype=np.int32, buffer=shm.buf)
+        items = []
+        offset = 0
+        for length, (inputs, original_text) in zip(lengths, rest):
+            if length is not None:
+                input_ids = torch.from_numpy(buffer[offset:offset+length].astype(np.int64)).unsqueeze(0)
+                inputs = BatchEncoding({"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)})
+                offset += length
+            items.append((inputs, original_text))
+        # the arrays above are copies, so nothing points into the buffer anymore
+        del buffer
+    finally:
+        shm.close()
+        shm.unlink()
+    return items
+
+
+def prepare_all_inputs(dataset: TestItemDataset, num_workers: int=0, chunk_size: int=16):
+    """
+    Prepare all the inputs of the dataset, returns a list of (inputs, original_text) in the order of the dataset.
+    With num_workers > 0, contiguous chunks of chunk_size samples are prepared in a pool of forked processes, so that the models can batch the tokenization within a chunk (see LLM.prepare_inputs_batch).
+    """
+    precheck = getattr(dataset.llm, "length_precheck", None)
+    if num_workers <= 0:
+        items = []
+        for start in tqdm(range(0, len(dataset), chunk_size), desc="Preparing inputs"):
+            items += dataset.get_items(start, min(start+chunk_size, len(dataset)))
+        if precheck is not None:
+            precheck.log_stats()
+        return items
+
+    prepare_context["dataset"] = dataset
+    items = [None] * len(dataset)
+    try:
+        with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("fork"), initializer=init_prepare_worker) as executor:
+            futures = {executor.submit(prepare_chunk, start, min(start+chunk_size, len(dataset))): start for start in range(0, len(dataset), chunk_size)}
+            with tqdm(total=len(dataset), desc="Preparing inputs") as pbar:
+                for future in as_completed(futures):
+                    start = futures[future]
+                    shm_name, lengths, rest, stats = future.result()
+                    chunk = read_chunk(shm_name, lengths, rest)
+                    items[start:start+len(chunk)] = chunk
+                    if stats is not None:
+                        precheck.merge_stats(stats)
+                    pbar.update(len(chunk))
+    finally:
+        prepare_context.clear()
+    if precheck is not None:
+        precheck.log_stats()
+    return items
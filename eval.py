@@ -1,22 +1,28 @@
 import os
 
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import copy
 import re
 import random
 import json
 import time
+import hashlib
+import itertools
 
 from tqdm import tqdm
 import numpy as np
 import torch
-from torch.utils.data import DataLoader
 
 from arguments import parse_arguments
-from model_utils import load_LLM, OpenAIModel, AnthropicModel, TgiVllmModel
+from result_io import ResultWriter
+from token_index import evict_token_index
+from model_utils import load_LLM, OpenAIModel, AnthropicModel, TgiVllmModel, get_request_order, get_prefix_units, estimate_cached_prefix, add_telemetry, log_once, get_max_memory_allocated
 
 from data import (
     load_data,
     TestItemDataset,
+    prepare_all_inputs,
 )
 
 import logging
@@ -26,40 +32,104 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
-def run_test(args, model, dataset, test_file, demo_file):
-    logger.info(f"running test on {dataset} with test {test_file} and demo {demo_file}")
+def get_input_hash(inputs):
+    """
+    Hash the prepared input so that we can check if a checkpointed output still corresponds to the same input.
+    The inputs are either tokenized (HF-based models) or strings/chat messages (API models).
+    """
+    if hasattr(inputs, "keys") and "input_ids" in inputs:
+        payload = json.dumps(inputs["input_ids"][0].tolist())
+    else:
+        payload = json.dumps(inputs, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def load_checkpoint(checkpoint_path, input_hashes):
+    """
+    Load the finished samples from the append-only jsonl checkpoint.
+    Each line is {"idx": int, "hash": str, "output": dict}, and we only keep the lines whose hash matches the current input.
+    Returns a dictionary from the sample index to the raw model output.
+    """
+    finished = {}
+    if not os.path.exists(checkpoint_path):
+        return finished
+
+    with open(checkpoint_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line may be partially written if the process was killed
+                continue
+            idx = record["idx"]
+            if idx < len(input_hashes) and record["hash"] == input_hashes[idx]:
+                finished[idx] = record["output"]
+    return finished
+
+
+def save_checkpoint(task, idx, output):
+    # failed samples are not saved so they are retried when resuming
+    if output is None:
+        return
+    with open(task["checkpoint_path"], "a") as f:
+        f.write(json.dumps({"idx": idx, "hash": task["input_hashes"][idx], "output": output}, ensure_ascii=False) + "\n")
+
+
+def summarize_telemetry(results, total_time):
+    """
+    Summarize the per-request telemetry (see model_utils.add_telemetry) into p50/p90/p99 percentiles,
+    and the prefill (input) and decode (output) token throughput over the whole run.
+    results should only contain the samples generated in total_time, not the ones resumed from a checkpoint.
+    """
+    telemetry = {}
+    for key in ["queue_time", "ttft", "latency", "decode_tokens_per_sec"]:
+        values = [r[key] for r in results if r.get(key, None) is not None]
+        if len(values) > 0:
+            for p in [50, 90, 99]:
+                telemetry[f"{key}_p{p}"] = float(np.percentile(values, p))
+    peak_memory = [r["peak_memory"] for r in results if r.get("peak_memory", None) is not None]
+    if len(peak_memory) > 0:
+        telemetry["peak_memory_gb"] = max(peak_memory)
+    cached_tokens = [r["cached_tokens"] for r in results if r.get("cached_tokens", None) is not None]
+    if len(cached_tokens) > 0:
+        telemetry["prefix_cache_hits"] = sum([c > 0 for c in cached_tokens])
+        telemetry["prefix_cache_misses"] = sum([c == 0 for c in cached_tokens])
+        telemetry["prefix_cache_token_fraction"] = sum(cached_tokens) / max(sum([r["input_len"] for r in results if r.get("cached_tokens", None) is not None]), 1)
+    telemetry["prefill_throughput"] = sum([r["input_len"] for r in results]) / total_time
+    telemetry["decode_throughput"] = sum([r["output_len"] for r in results]) / total_time
+    return telemetry
+
+
+def get_output_path(args, dataset, test_file):
     # dataset specific changes tag
     tag = args.tag
     if dataset == "popqa":
         tag += f"_pop{args.popularity_threshold}"
 
     test_name = os.path.splitext(os.path.basename(test_file))[0]
-    output_path = os.path.join(args.output_dir, f"{dataset}_{tag}_{test_name}_in{args.input_max_length}_size{args.max_test_samples}_shots{args.shots}_samp{args.do_sample}max{args.generation_max_length}min{args.generation_min_length}t{args.temperature}p{args.top_p}_chat{args.use_chat_template}_{args.seed}.json")
-    if os.path.exists(output_path) and not args.overwrite and not args.debug:
-        logger.info(f"{output_path} already exists, skipping...")
-        return output_path
+    return os.path.join(args.output_dir, f"{dataset}_{tag}_{test_name}_in{args.input_max_length}_size{args.max_test_samples}_shots{args.shots}_samp{args.do_sample}max{args.generation_max_length}min{args.generation_min_length}t{args.temperature}p{args.top_p}_chat{args.use_chat_template}_{args.seed}.json")
 
+
+def prepare_test(args, model, dataset, test_file, demo_file, output_path):
+    """
+    Load the data and prepare all the inputs for one dataset, and load the finished samples from the checkpoint.
+    Returns a dictionary (task) that contains everything needed to run the generation and the evaluation.
+    """
     random.seed(args.seed)
     data = load_data(args, dataset, test_file, demo_file)
     logger.info(f"loaded {len(data['data'])} samples from {dataset}")
 
-    dataloader = DataLoader(
-        TestItemDataset(data, model, model.tokenizer),
-        batch_size=1,
-        shuffle=False,
-        collate_fn=lambda x: x,
+    # we first prepare all inputs and then run the evaluation in batch
+    # the inputs are prepared in chunks by a process pool, see data.prepare_all_inputs
+    items = prepare_all_inputs(
+        TestItemDataset(data, model, model.tokenizer, full_decode=args.debug),
         num_workers=args.num_workers if not args.debug else 0,
+        chunk_size=args.prepare_chunk_size,
     )
-
-    # we first prepare all inputs and then run the evaluation in batch
-    # the dataloader is a bit of an overkill here, but it makes it easier to switch back to iterative instead of batch eval
     metrics = defaultdict(list)
     all_inputs = []
     all_input_texts = []
-    # print("start here")
-    # print(f"{len(dataloader)}")
-    for idx, inputs in enumerate(tqdm(dataloader, desc="Preparing inputs")):
-        inputs, input_text = inputs[0]
+    for inputs, input_text in items:
         if args.count_tokens:
             # count_tokens is only available for models that tokenizes the input
             metrics['input_len'].append(inputs.input_ids.shape[1])
@@ -87,21 +157,103 @@ def run_test(args, model, dataset, test_file, demo_file):
     # print(all_input_texts)
     # exit(0)
     
-    start_time = time.time()
-    # generate all outputs
-    if (isinstance(model, OpenAIModel) or isinstance(model, AnthropicModel)) and (not isinstance(model, TgiVllmModel)):
-        # using the batch API makes it cheaper and faster
-        logger.info(f"Using the OpenAI/Anthropic batch API by default, if you want to use the iterative API, please change the code")
-        all_outputs = model.generate_batch(all_inputs, batch_file=output_path+".batch")
-    else:
-        all_outputs = model.generate_batch(all_inputs)
-    end_time = time.time()
+    # every finished sample is appended to the checkpoint file, so we can resume from it if the run is interrupted
+    checkpoint_path = output_path + ".partial.jsonl"
+    input_hashes = [get_input_hash(inputs) for inputs in all_inputs]
+    if args.overwrite and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    finished = load_checkpoint(checkpoint_path, input_hashes)
+    pending = [idx for idx in range(len(all_inputs)) if idx not in finished]
+    if len(finished) > 0:
+        logger.info(f"Resuming from {checkpoint_path}: {len(finished)} samples already finished, generating the remaining {len(pending)}")
+
+    cached_prefix_fraction, prefix_order = None, None
+    if args.ordering == "prefix":
+        # the units are computed once, and the order is passed on to the model in generate_pending
+        pending_inputs = [all_inputs[idx] for idx in pending]
+        units = [get_prefix_units(x) for x in pending_inputs]
+        prefix_order = get_request_order(pending_inputs, "prefix", units=units)
+        cached_prefix_fraction = estimate_cached_prefix(units, prefix_order)
+        logger.info(f"Estimated cached prefix fraction for {dataset}: {cached_prefix_fraction*100:.02f}%")
+
+    return {
+        "args": args,
+        "model": model,
+        "dataset": dataset,
+        "output_path": output_path,
+        "checkpoint_path": checkpoint_path,
+        "data": data,
+        "metrics": metrics,
+        "all_inputs": all_inputs,
+        "all_input_texts": all_input_texts,
+        "input_hashes": input_hashes,
+        "finished": finished,
+        "pending": pending,
+        "cached_prefix_fraction": cached_prefix_fraction,
+        "prefix_order": prefix_order,
+    }
 
-    # then we do all the postprocessing + evaluation
-    results = []
+
+def use_scoring(task):
+    if not task["args"].score_candidates or "candidates" not in task["data"]:
+        return False
+    if not task["model"].supports_scoring:
+        log_once(f"{type(task['model']).__name__} does not support candidate scoring, generating instead", logger=logger, level="warning")
+        return False
+    return True
+
+
+def generate_pending(task):
+    """
+    Generate the samples that are not in the checkpoint yet, and yield (index, output) as soon as each one is ready.
+    """
+    model, pending = task["model"], task["pending"]
+    pending_inputs = [task["all_inputs"][idx] for idx in pending]
+    if len(pending_inputs) == 0:
+        return
+    model.submission_order = task["prefix_order"]
+    if use_scoring(task):
+        # the candidates continue the prompt the same way as the generated output would, see the system_template in evaluate_test
+        args, data = task["args"], task["data"]
+        continuations = []
+        for idx in pending:
+            prefix = data["system_template"].format(**data["data"][idx]) + " " if args.use_chat_template else " "
+            continuations.append([prefix + c for c in data["candidates"]])
+        outputs = model.score_iter(pending_inputs, continuations)
+    elif (isinstance(model, OpenAIModel) or isinstance(model, AnthropicModel)) and (not isinstance(model, TgiVllmModel)) and not task["args"].use_async:
+        # using the batch API makes it cheaper and faster, --use_async sends the requests directly instead
+        logger.info(f"Using the OpenAI/Anthropic batch API by default, use --use_async to send the requests directly instead")
+        outputs = model.generate_iter(pending_inputs, batch_file=task["output_path"]+".batch")
+    else:
+        outputs = model.generate_iter(pending_inputs)
+
+    for i, output in outputs:
+        idx = pending[i]
+        if output is not None and "candidate_logprobs" in output:
+            output["candidate_logprobs"] = dict(zip(task["data"]["candidates"], output["candidate_logprobs"]))
+        save_checkpoint(task, idx, output)
+        yield idx, output
+    # not all the models consume the order (e.g., the vllm offline engine)
+    model.submission_order = None
+
+
+def evaluate_test(task, all_outputs, start_time):
+    """
+    Post-process and evaluate the outputs as they come in, then write the results to the output file.
+    all_outputs is an iterable of (index, output).
+    """
+    args, dataset, data = task["args"], task["dataset"], task["data"]
+    output_path, metrics, all_input_texts = task["output_path"], task["metrics"], task["all_input_texts"]
+
+    # then we do all the postprocessing + evaluation as the outputs come in
+    # the outputs may arrive out of order, so we key everything by the sample index and sort at the end
+    results = {}
+    sample_metrics = {}
+    # the large fields (e.g., the input text of the API models) are written out as soon as each sample is scored, see result_io.py
+    writer = ResultWriter(output_path) if args.output_dir is not None and not args.count_tokens else None
     total_num = 0
     valid_num = 0
-    for idx, output in enumerate(all_outputs):
+    for idx, output in all_outputs:
         test_item = data["data"][idx]
         input_text = all_input_texts[idx]
         total_num += 1
@@ -127,17 +279,14 @@ def run_test(args, model, dataset, test_file, demo_file):
 
         mets, others = data['post_process'](output, test_item)
         output.update({**others, **mets})
-        for k, v in mets.items():
-            metrics[k].append(v)
+        sample_metrics[idx] = {**mets, "input_len": output["input_len"], "output_len": output["output_len"]}
 
-        metrics["input_len"].append(output["input_len"])
-        metrics["output_len"].append(output["output_len"])
         result = {**test_item, **output}
         result.pop("context", None)
         result.pop("input_ids", None)
         if input_text is None:
             input_text = result['input_text']
-        results.append(result)
+        results[idx] = writer.compact(result) if writer is not None else result
 
         # print out some examples, we also limit how much we print out since it can get really long
         if idx < 5 or args.debug:
@@ -154,11 +303,27 @@ def run_test(args, model, dataset, test_file, demo_file):
 
         if args.debug:
             import pdb; pdb.set_trace()
+    end_time = time.time()
+
+    # restore the original sample order so that the output files are deterministic
+    for idx in sorted(sample_metrics):
+        for k, v in sample_metrics[idx].items():
+            metrics[k].append(v)
+    # the samples resumed from the checkpoint were generated in an earlier run, so they are left out of this run's telemetry
+    generated = [results[idx] for idx in sorted(results) if idx not in task["finished"]]
+    results = [results[idx] for idx in sorted(results)]
 
     if not args.no_cuda:
-        mem_usage = sum([torch.cuda.max_memory_allocated(i) for i in range(torch.cuda.device_count())])
+        # the models reset the peak stats for each sample (see model_utils.reset_peak_memory), this is still the peak since the start of the run
+        mem_usage = get_max_memory_allocated()
         logger.info(f"Memory usage: {mem_usage/1000**3:.02f} GB")
     logger.info(f"Total time: {end_time - start_time:.02f} s")
+    telemetry = summarize_telemetry(generated, end_time - start_time)
+    if task["cached_prefix_fraction"] is not None:
+        telemetry["cached_prefix_fraction"] = task["cached_prefix_fraction"]
+    if getattr(args, "prefill_chunk_size", None) is not None:
+        telemetry["prefill_chunk_size"] = args.prefill_chunk_size
+    logger.info("Telemetry: " + ", ".join([f"{k}: {v:.03f}" for k, v in telemetry.items()]))
     logger.info(f"Throughput: {len(results) / (end_time - start_time):.02f} samples/s")
 
     if args.count_tokens:
@@ -167,6 +332,8 @@ def run_test(args, model, dataset, test_file, demo_file):
 
     if len(results) == 0:
         logger.error("No results to evaluate, something went wrong, returning...")
+        if writer is not None:
+            writer.abort()
         return output_path
 
     averaged_metrics = {k: np.mean(v)*(100 if "_len" not in k else 1) for k, v in metrics.items()}
@@ -182,6 +349,7 @@ def run_test(args, model, dataset, test_file, demo_file):
         "metrics": metrics,
         "averaged_metrics": averaged_metrics,
         "throughput": len(results) / (end_time - start_time),
+        "telemetry": telemetry,
         "total_sample": total_num,
         "valid_sample": valid_num,
         "valid_ratio": f"{valid_num / total_num * 100:.2f}%",
@@ -190,23 +358,149 @@ def run_test(args, model, dataset, test_file, demo_file):
         output["memory_usage"] = mem_usage
 
     if args.output_dir is not None:
-        with open(output_path, "w") as f:
-            json.dump(output, f, indent=4, ensure_ascii=False,)
+        # the samples are written one per line in the original order, and the long inputs are stored once in a compressed blob file
+        for sample in results:
+            writer.write(sample)
+        writer.close(**{k: v for k, v in output.items() if k != "data"})
         # this makes it easier to parse results, but alce uses a different evaluation script
         if not "alce" in dataset:
             with open(output_path + ".score", "w") as f:
-                json.dump(output["averaged_metrics"], f, indent=4, ensure_ascii=False,)
+                json.dump({**output["averaged_metrics"], **output["telemetry"]}, f, indent=4, ensure_ascii=False,)
         logger.info(f"done, results are written to {output_path}")
+        # the final output contains everything in the checkpoint now
+        if os.path.exists(task["checkpoint_path"]):
+            os.remove(task["checkpoint_path"])
 
     return output_path
 
 
+def run_test(args, model, dataset, test_file, demo_file):
+    logger.info(f"running test on {dataset} with test {test_file} and demo {demo_file}")
+    output_path = get_output_path(args, dataset, test_file)
+    if os.path.exists(output_path) and not args.overwrite and not args.debug:
+        logger.info(f"{output_path} already exists, skipping...")
+        return output_path
+
+    task = prepare_test(args, model, dataset, test_file, demo_file, output_path)
+    start_time = time.time()
+    # generate all outputs, the outputs are yielded as soon as they are ready so that the post-processing overlaps with the generation
+    all_outputs = itertools.chain(task["finished"].items(), generate_pending(task))
+    return evaluate_test(task, all_outputs, start_time)
+
+
+def run_alce_eval(args, dataset, output_path):
+    if "alce" in dataset and not args.count_tokens and (not os.path.exists(output_path+".score") or args.overwrite):
+        import eval_alce
+        logger.info("running eval_alce.py...")
+        cli_args = ["--f", output_path]
+        if not "nocite" in dataset:
+            cli_args.append("--citations")
+        # HY: If you want to run the full ALCE evaluation, you should uncomment the following lines
+        # In HELMET, we don't use the MAUVE scores.
+        # if "asqa" in dataset:
+        #     cli_args.append("--mauve")
+        # elif "eli5" in dataset:
+        #   cli_args += ["mauve", "--claims_nli"]
+        eval_alce.main(cli_args)
+
+
+def run_shared_pool(args, model, evals):
+    """
+    Run all the (dataset, length) pairs through one shared pool of requests instead of one dataset at a time.
+    The serving engine is kept busy across datasets instead of draining at the end of each one,
+    and each dataset is evaluated as soon as its last request returns.
+    This is only used for the serving backends (TgiVllmModel), where every request is independent.
+    """
+    tasks = []
+    for dataset, test_file, demo_file, max_length, gen_length in evals:
+        # each dataset has its own generation settings, the copies share the same client and tokenizer
+        task_args = copy.copy(args)
+        task_args.datasets = dataset
+        task_args.test_files = test_file
+        task_args.demo_files = demo_file
+        task_args.input_max_length = max_length
+        task_args.generation_max_length = gen_length
+        task_model = copy.copy(model)
+        task_model.max_length = max_length
+        task_model.generation_max_length = gen_length
+
+        logger.info(f"preparing {dataset} with test {test_file} and demo {demo_file}")
+        output_path = get_output_path(task_args, dataset, test_file)
+        if os.path.exists(output_path) and not args.overwrite and not args.debug:
+            logger.info(f"{output_path} already exists, skipping...")
+            continue
+        try:
+            tasks.append(prepare_test(task_args, task_model, dataset, test_file, demo_file, output_path))
+        except Exception as e:
+            logger.exception(e)
+            logger.error(f"Error in {dataset}, continuing...")
+            if args.debug:
+                raise e
+
+    def finish(t):
+        task = tasks[t]
+        try:
+            # the throughput of each dataset is measured from when its first request was sent, not from the start of the pool
+            task_start = min(started[t].values()) if len(started[t]) > 0 else time.time()
+            output_path = evaluate_test(task, sorted(all_outputs[t].items()), task_start)
+            run_alce_eval(task["args"], task["dataset"], output_path)
+        except Exception as e:
+            logger.exception(e)
+            logger.error(f"Error in {task['dataset']}, continuing...")
+            if args.debug:
+                raise e
+
+    all_outputs = [dict(task["finished"]) for task in tasks]
+    remaining = [len(task["pending"]) for task in tasks]
+    started = [{} for _ in tasks]
+    max_workers = int(os.getenv("MAX_WORKERS", "32"))
+    logger.info(f"Submitting {sum(remaining)} requests from {len(tasks)} datasets to a shared pool of {max_workers} workers")
+
+    def run_request(t, idx, submit_time):
+        request_start = time.time()
+        started[t][idx] = request_start
+        output = tasks[t]["model"].generate(tasks[t]["all_inputs"][idx])
+        return add_telemetry(output, submit_time, request_start, time.time())
+
+    requests = [(t, idx) for t, task in enumerate(tasks) for idx in task["pending"]]
+    if args.ordering == "prefix":
+        # the datasets do not share prefixes, so each one keeps the order computed in prepare_test
+        order, offset = [], 0
+        for task in tasks:
+            order += [offset + i for i in task["prefix_order"]]
+            offset += len(task["pending"])
+    else:
+        # the ordering policy is applied across all the datasets
+        order = get_request_order([tasks[t]["all_inputs"][idx] for t, idx in requests], args.ordering)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for i in order:
+            t, idx = requests[i]
+            futures[executor.submit(run_request, t, idx, time.time())] = (t, idx)
+
+        for t in range(len(tasks)):
+            if remaining[t] == 0:
+                finish(t)
+
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Generating"):
+            t, idx = futures[future]
+            output = future.result()
+            save_checkpoint(tasks[t], idx, output)
+            all_outputs[t][idx] = output
+            remaining[t] -= 1
+            # the other datasets keep generating in the background while we evaluate this one
+            if remaining[t] == 0:
+                finish(t)
+
+
 def main():
     args = parse_arguments()
 
     logger.info(f"Arguments: {args}")
     assert args.model_name_or_path is not None
     os.makedirs(args.output_dir, exist_ok=True)
+    # the token offsets of the documents are indexed across runs, see token_index.py
+    evict_token_index(max_size_gb=args.token_index_max_gb, max_age_days=args.token_index_max_days)
 
     datasets = args.datasets.split(",")
     test_files = args.test_files.split(",")
@@ -234,6 +528,16 @@ def main():
     _evals = list(_evals)
     logger.info(f"Total Eval Task: {len(_evals)}")
     model = load_LLM(args)  
+    model.ordering = args.ordering
+    model.use_async = args.use_async
+    model.max_concurrency = args.max_concurrency
+    model.stream = args.stream
+
+    if args.shared_pool:
+        if isinstance(model, TgiVllmModel):
+            run_shared_pool(args, model, _evals)
+            return
+        logger.warning("shared_pool is only supported for the serving backends, running the datasets one at a time...")
 
     # print(list(_evals))
     for dataset, test_file, demo_file, max_length, gen_length in _evals:
@@ -253,21 +557,7 @@ def main():
         try:
             print("run_test...")
             output_path = run_test(args, model, dataset, test_file, demo_file)
-            
-
-            if "alce" in dataset and not args.count_tokens and (not os.path.exists(output_path+".score") or args.overwrite):
-                import eval_alce
-                logger.info("running eval_alce.py...")
-                cli_args = ["--f", output_path]
-                if not "nocite" in dataset:
-                    cli_args.append("--citations")
-                # HY: If you want to run the full ALCE evaluation, you should uncomment the following lines
-                # In HELMET, we don't use the MAUVE scores.
-                # if "asqa" in dataset:
-                #     cli_args.append("--mauve")
-                # elif "eli5" in dataset:
-                #   cli_args += ["mauve", "--claims_nli"]
-                eval_alce.main(cli_args)
+            run_alce_eval(args, dataset, output_path)
 
         except Exception as e:
             # in case we run into some kind of error
@@ -25,6 +25,7 @@ from transformers import (
 )
 
 from utils import normalize_answer, get_max_memory, remove_citations
+from result_io import load_results
 
 QA_MODEL="gaotianyu1350/roberta-large-squad"
 AUTOAIS_MODEL="google/t5_xxl_true_nli_mixture"
@@ -499,8 +500,7 @@ def main(args=None):
     else:
         args = parser.parse_args(args)
 
-    with open(args.f) as f:
-        data_with_config = json.load(f)
+    data_with_config = load_results(args.f, resolve_blobs=False)
     data = data_with_config['data']
 
     if "qampari" in args.f:
@@ -1,13 +1,22 @@
 import os
 import time
+import inspect
 import json
+import math
+import queue
+import asyncio
+import threading
+from types import SimpleNamespace
 from typing import Optional, List, Dict, Callable, Any
 import functools
+from collections import defaultdict, OrderedDict
 
 import torch
-from transformers import PreTrainedTokenizer, set_seed
+from transformers import PreTrainedTokenizer, BatchEncoding, set_seed
 from tqdm import tqdm
-from tqdm.contrib.concurrent import thread_map
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from token_index import get_token_offsets, CACHE_DIR
 
 import logging
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
@@ -80,6 +89,543 @@ def call_api(func:Callable, limit: int=5, pause: int=10):
     return output
 
 
+async def call_api_async(func: Callable, limit: int=5, pause: int=10):
+    """
+    The same as call_api, but for the async clients: func should return a coroutine.
+    """
+    count = 0
+    while True:
+        try:
+            output = await func()
+            break
+        except Exception as e:
+            logger.info(f"Exception while using api: {e}")
+            msg = str(e).lower()
+            if "rate limit" in msg or "rate_limit" in msg or "quota" in msg or "429" in msg:
+                logger.info(f"Rate limit exceeded, waiting {pause} secs and retrying...")
+                await asyncio.sleep(pause)
+            elif count < limit:
+                logger.info(f"Encountered error {e}, retrying...")
+                count += 1
+            else:
+                logger.info("Skipping generation due to unknown error")
+                output = None
+                break
+    return output
+
+
+def get_input_length(inputs: Any) -> int:
+    """
+    Get the length of a prepared input, which is used to order the requests.
+    This is the number of tokens for tokenized inputs (HF-based models), and the number of characters otherwise (e.g., the chat messages for the API models).
+    The character count is only used as a relative measure between the inputs of the same run.
+    """
+    if inputs is None:
+        return 0
+    if hasattr(inputs, "keys") and "input_ids" in inputs:
+        input_ids = inputs["input_ids"]
+        if hasattr(input_ids, "shape"):
+            return input_ids.shape[-1]
+        return len(input_ids[0]) if len(input_ids) > 0 and isinstance(input_ids[0], list) else len(input_ids)
+    if isinstance(inputs, str):
+        return len(inputs)
+    # chat format
+    return sum([len(str(x.get("content", ""))) for x in inputs])
+
+
+def order_by_length(lengths: List[int], policy: str="original") -> List[int]:
+    """
+    Get the order in which the requests are submitted, the callers always map the outputs back to the original order.
+     - original: the dataset order
+     - longest_first: the longest inputs first, so that a few long requests submitted last do not set the tail latency
+     - bucketed: group the inputs into power-of-two length buckets and submit the buckets from the longest to the shortest, keeping the dataset order within each bucket
+    """
+    if policy == "original":
+        return list(range(len(lengths)))
+    elif policy == "longest_first":
+        return sorted(range(len(lengths)), key=lambda i: -lengths[i])
+    elif policy == "bucketed":
+        return sorted(range(len(lengths)), key=lambda i: -int(math.log2(max(lengths[i], 1))))
+    raise ValueError(f"Unknown ordering policy {policy}")
+
+
+def get_prefix_units(inputs: Any) -> Any:
+    """
+    Get the prepared input as a sequence that can be compared by prefix: the token ids for tokenized inputs, and the text otherwise.
+    For the chat format, the roles and contents are concatenated in order, so that a shared system message and a shared start of the user message form a shared prefix.
+    """
+    if inputs is None:
+        return ""
+    if hasattr(inputs, "keys") and "input_ids" in inputs:
+        input_ids = inputs["input_ids"]
+        if hasattr(input_ids, "tolist"):
+            input_ids = input_ids.tolist()
+        return input_ids[0] if len(input_ids) > 0 and isinstance(input_ids[0], list) else input_ids
+    if isinstance(inputs, str):
+        return inputs
+    return "".join([f"{x.get('role', '')}\n{x.get('content', '')}\n" for x in inputs])
+
+
+def common_prefix_length(a: Any, b: Any) -> int:
+    # binary search over the slice comparisons, which are done in C, this is much faster than comparing the long contexts element by element
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        mid = (low + high + 1) // 2
+        if a[:mid] == b[:mid]:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
+def order_by_prefix(units: List[Any]) -> List[int]:
+    """
+    Order the inputs so that the ones sharing a prefix (e.g., several questions over the same book, or the same instruction and demos) are submitted back to back.
+    Sorting the sequences places every input next to the one it shares the longest prefix with, so the prefix caches of the serving engines (vLLM/SGLang) can reuse it while it is still cached.
+    """
+    return sorted(range(len(units)), key=lambda i: units[i])
+
+
+def estimate_cached_prefix(units: List[Any], order: List[int]) -> float:
+    """
+    Estimate the fraction of the input tokens (or characters) that can be served from a prefix cache when the inputs are submitted in this order.
+    Each input is counted as sharing its prefix with the previous one only, assuming the cache holds the most recent prefix.
+    """
+    total = sum([len(u) for u in units])
+    if total == 0:
+        return 0.0
+    cached = sum([common_prefix_length(units[a], units[b]) for a, b in zip(order[:-1], order[1:])])
+    return cached / total
+
+
+def get_length_buckets(lengths: List[int], token_budget: int, max_batch_size: int=32) -> List[List[int]]:
+    """
+    Group the indices into batches of similar lengths, such that the batch size times the longest length in the batch (the padded size) fits the token budget.
+    The indices are sorted by length (longest first) to minimize the padding, and an input longer than the budget gets a batch of its own.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    batches = []
+    for idx in order:
+        # the first index of each batch is the longest one
+        if len(batches) > 0 and len(batches[-1]) < max_batch_size and (len(batches[-1]) + 1) * lengths[batches[-1][0]] <= token_budget:
+            batches[-1].append(idx)
+        else:
+            batches.append([idx])
+    return batches
+
+
+def get_request_order(inputs: List[Any], policy: str="original", units: Optional[List[Any]]=None) -> List[int]:
+    """
+    Get the submission order of the prepared inputs according to the ordering policy, see order_by_length and order_by_prefix.
+    units are the precomputed get_prefix_units of the inputs for the prefix policy, if the caller also needs them.
+    """
+    if policy == "prefix":
+        return order_by_prefix(units if units is not None else [get_prefix_units(x) for x in inputs])
+    return order_by_length([get_input_length(x) for x in inputs], policy)
+
+
+def add_telemetry(output: Optional[Dict[str, Any]], submit_time: float, start_time: float, end_time: float) -> Optional[Dict[str, Any]]:
+    """
+    Add the per-request latency telemetry to the output (in place):
+     - submit_time: when the request was submitted (unix time)
+     - queue_time: seconds between the submission and the start of the request (e.g., waiting for a free worker)
+     - latency: seconds from the start to the end of the request
+     - ttft: time to first token in seconds, only if the model sets it (streaming API backends and HF prefill)
+     - decode_tokens_per_sec: output tokens per second after the first token (or over the whole request if the ttft is unknown)
+    """
+    if output is None:
+        return output
+    latency = end_time - start_time
+    ttft = output.get("ttft", None)
+    decode_time = latency - ttft if ttft is not None else latency
+    output.update({
+        "submit_time": submit_time,
+        "queue_time": start_time - submit_time,
+        "latency": latency,
+        "ttft": ttft,
+        "decode_tokens_per_sec": output["output_len"] / decode_time if decode_time > 0 else None,
+    })
+    return output
+
+
+# the peak memory of each GPU before the last reset_peak_memory, so the peak of the whole run is still known (see get_max_memory_allocated)
+peak_memory_before_reset = defaultdict(int)
+
+
+def reset_peak_memory():
+    if torch.cuda.is_available():
+        for i in range(torch.cuda.device_count()):
+            peak_memory_before_reset[i] = max(peak_memory_before_reset[i], torch.cuda.max_memory_allocated(i))
+            torch.cuda.reset_peak_memory_stats(i)
+
+
+def get_max_memory_allocated() -> int:
+    """
+    Get the peak memory in bytes since the start of the process summed over the GPUs, like torch.cuda.max_memory_allocated without the per-sample resets of reset_peak_memory.
+    """
+    return sum([max(peak_memory_before_reset[i], torch.cuda.max_memory_allocated(i)) for i in range(torch.cuda.device_count())])
+
+
+def get_peak_memory() -> float:
+    """
+    Get the peak memory in GB since the last reset_peak_memory, summed over the GPUs.
+    Without GPUs, this is the max resident set size of the process, which cannot be reset, so it is the peak of the run so far.
+    """
+    if torch.cuda.is_available():
+        return sum([torch.cuda.max_memory_allocated(i) for i in range(torch.cuda.device_count())]) / 1e9
+    import resource
+    # ru_maxrss is in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e6
+
+
+class StreamCollector:
+    """
+    Rebuild the fields of the non-streamed (chat) completion that we use from the chunks of a stream, so the same parsing applies.
+    The time to first token (from start_time) is saved in the ttft attribute.
+    Some providers do not send the usage with the stream, then the output tokens are counted as the content chunks (about one token each),
+    and the input tokens are left as None for the model to count (see OpenAIModel.fill_missing_usage).
+    """
+    def __init__(self, start_time: float):
+        self.start_time = start_time
+        self.pieces = []
+        self.usage = None
+        self.fingerprint = None
+        self.ttft = None
+
+    def add(self, chunk):
+        if getattr(chunk, "usage", None) is not None:
+            self.usage = chunk.usage
+        self.fingerprint = getattr(chunk, "system_fingerprint", None) or self.fingerprint
+        if len(chunk.choices) == 0:
+            return
+        choice = chunk.choices[0]
+        piece = choice.delta.content if hasattr(choice, "delta") else choice.text
+        if piece:
+            if self.ttft is None:
+                self.ttft = time.time() - self.start_time
+            self.pieces.append(piece)
+
+    def result(self):
+        text = "".join(self.pieces)
+        usage = self.usage
+        if usage is None:
+            log_once("the stream did not return the usage, counting the output tokens as the number of chunks", key="stream_usage", logger=logger, level="warning")
+            usage = SimpleNamespace(prompt_tokens=None, completion_tokens=len(self.pieces))
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=text), text=text)],
+            usage=usage,
+            system_fingerprint=self.fingerprint,
+            ttft=self.ttft,
+        )
+
+
+def collect_stream(stream, start_time: float):
+    collector = StreamCollector(start_time)
+    for chunk in stream:
+        collector.add(chunk)
+    return collector.result()
+
+
+async def collect_stream_async(stream, start_time: float):
+    collector = StreamCollector(start_time)
+    async for chunk in stream:
+        collector.add(chunk)
+    return collector.result()
+
+
+def thread_imap(func: Callable, inputs: List[Any], prompt: List[Any], max_workers: int=32, order: Optional[List[int]]=None):
+    """
+    Similar to tqdm's thread_map, but yields (index, output) as soon as each call finishes instead of waiting for all of them.
+    The requests are submitted in the given order (defaults to the input order).
+    The order of the yielded outputs is not guaranteed, use the index to map them back to the inputs.
+    """
+    if order is None:
+        order = range(len(inputs))
+
+    submit_time = time.time()
+    def run(i, p):
+        start_time = time.time()
+        output = func(i, p)
+        return add_telemetry(output, submit_time, start_time, time.time())
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(run, inputs[idx], prompt[idx]): idx for idx in order}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            yield futures[future], future.result()
+
+
+def async_imap(func: Callable, inputs: List[Any], prompt: List[Any], max_concurrency: int=256, order: Optional[List[int]]=None):
+    """
+    Similar to thread_imap, but func is a coroutine function and all the requests run on one event loop in a background thread.
+    At most max_concurrency requests are in flight at the same time, which can be much higher than the number of threads we would want to use.
+    Yields (index, output) as soon as each request finishes, use the index to map them back to the inputs.
+    """
+    if order is None:
+        order = range(len(inputs))
+    order = list(order)
+    results = queue.Queue()
+
+    submit_time = time.time()
+    async def run_all():
+        semaphore = asyncio.Semaphore(max_concurrency)
+        async def run(idx):
+            async with semaphore:
+                try:
+                    start_time = time.time()
+                    output = await func(inputs[idx], prompt[idx])
+                    results.put((idx, add_telemetry(output, submit_time, start_time, time.time()), None))
+                except Exception as e:
+                    results.put((idx, None, e))
+        await asyncio.gather(*[run(idx) for idx in order])
+
+    # the event loop runs in its own thread so the requests keep going while the caller processes the outputs
+    thread = threading.Thread(target=asyncio.run, args=(run_all(),), daemon=True)
+    thread.start()
+    for _ in tqdm(range(len(order))):
+        idx, output, error = results.get()
+        if error is not None:
+            raise error
+        yield idx, output
+    thread.join()
+
+
+class LengthPrecheck:
+    """
+    Decide from the length of a prompt in bytes whether it is clearly under the token budget, so the API models can skip the exact tokenization (and truncation).
+    Two checks let a prompt skip the tokenization:
+    1. a hard bound: the tokenizers of the API models (byte-level BPE, or sentencepiece with byte fallback) never produce more tokens than bytes,
+       so a prompt with at most budget - slack bytes always fits.
+    2. an estimate: the bytes per token of each (tokenizer, dataset) is calibrated on the first calibration_size prompts, which are always tokenized exactly.
+       A prompt only passes if its token count, estimated with the lowest ratio and scaled by the margin (2x by default), fits in the budget,
+       and if it does not contain more non-ascii characters or digits than the calibration prompts did, as those take more tokens per byte than prose.
+    The calibration is saved under $HELMET_CACHE_DIR/bytes_per_token so the later runs skip it, and one in recheck_every skipped prompts is still tokenized exactly:
+    if its count is above the estimate, the ratio is lowered and saved again.
+    The inputs may be prepared in forked workers (see data.prepare_all_inputs), which send their counts and exact samples back with pop_stats,
+    and the main process merges them with merge_stats and logs the counts once per dataset with log_stats.
+    """
+    VERSION = 2
+
+    def __init__(self, tokenizer_name: str, calibration_size: int=16, margin: float=2.0, slack: int=16, tolerance: float=0.02, recheck_every: int=50):
+        self.tokenizer_name = tokenizer_name
+        self.calibration_size = calibration_size
+        self.margin = margin
+        self.slack = slack
+        self.tolerance = tolerance
+        self.recheck_every = recheck_every
+        self.calibrations = {}
+        self.checked = defaultdict(int)
+        self.skipped = defaultdict(int)
+        self.estimated = defaultdict(int)
+        # the exact counts that changed the calibration since the last pop_stats, as (dataset, profile, num_tokens)
+        self.observed = []
+
+
+    def get_path(self, dataset):
+        return os.path.join(CACHE_DIR, "bytes_per_token", f"{self.tokenizer_name.replace('/', '__')}__{dataset}.json")
+
+
+    @staticmethod
+    def get_profile(text):
+        # the fraction of the bytes in multi-byte characters and the fraction of digits, the characters that take the most tokens per byte
+        num_bytes = len(text.encode("utf-8"))
+        non_ascii = (num_bytes - len(text)) / max(num_bytes, 1)
+        digits = sum(map(text.count, "0123456789")) / max(len(text), 1)
+        return num_bytes, non_ascii, digits
+
+
+    def get_calibration(self, dataset):
+        if dataset not in self.calibrations:
+            calibration = {"bytes_per_token": None, "non_ascii": 0.0, "digits": 0.0, "samples": 0}
+            path = self.get_path(dataset)
+            if os.path.exists(path):
+                with open(path) as f:
+                    d = json.load(f)
+                # the files written by an older version or with other settings are recalibrated
+                if d.get("version") == self.VERSION and d.get("calibration_size") == self.calibration_size:
+                    calibration = {k: d[k] for k in calibration}
+            self.calibrations[dataset] = calibration
+        return self.calibrations[dataset]
+
+
+    def save_calibration(self, dataset):
+        path = self.get_path(dataset)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + f".tmp{os.getpid()}", "w") as f:
+            json.dump({"version": self.VERSION, "calibration_size": self.calibration_size, **self.calibrations[dataset]}, f)
+        os.replace(path + f".tmp{os.getpid()}", path)
+
+
+    def is_under_budget(self, dataset: Optional[str], text: str, budget: int) -> bool:
+        num_bytes, non_ascii, digits = self.get_profile(text)
+        under = num_bytes + self.slack <= budget
+        # without the dataset name, we cannot tell which calibration applies, so only the hard bound is used
+        if not under and dataset is not None:
+            calibration = self.get_calibration(dataset)
+            under = calibration["samples"] >= self.calibration_size \
+                and non_ascii <= calibration["non_ascii"] + self.tolerance \
+                and digits <= calibration["digits"] + self.tolerance \
+                and num_bytes / calibration["bytes_per_token"] * self.margin <= budget
+            if under:
+                self.estimated[dataset] += 1
+                # spot check the calibration, the exact count goes through update
+                if self.estimated[dataset] % self.recheck_every == 0:
+                    under = False
+
+        self.checked[dataset] += 1
+        if under:
+            self.skipped[dataset] += 1
+        return under
+
+
+    def update(self, dataset: Optional[str], text: str, num_tokens: int):
+        if dataset is None or num_tokens == 0:
+            return
+        profile = self.get_profile(text)
+        if self.add_sample(dataset, profile, num_tokens):
+            self.observed.append((dataset, profile, num_tokens))
+
+
+    def add_sample(self, dataset: str, profile, num_tokens: int) -> bool:
+        """
+        Calibrate with the exact count of a prompt, returns whether the calibration changed.
+        """
+        calibration = self.get_calibration(dataset)
+        num_bytes, non_ascii, digits = profile
+        ratio = num_bytes / num_tokens
+        if calibration["samples"] < self.calibration_size:
+            calibration["bytes_per_token"] = min(ratio, calibration["bytes_per_token"] or ratio)
+            calibration["non_ascii"] = max(non_ascii, calibration["non_ascii"])
+            calibration["digits"] = max(digits, calibration["digits"])
+            calibration["samples"] += 1
+            if calibration["samples"] == self.calibration_size:
+                self.save_calibration(dataset)
+        elif ratio * self.margin < calibration["bytes_per_token"] and non_ascii <= calibration["non_ascii"] + self.tolerance and digits <= calibration["digits"] + self.tolerance:
+            # a prompt that would have passed the estimate has more tokens than the estimate allows for
+            logger.warning(f"Length pre-check for {dataset}: {num_tokens} tokens for {num_bytes} bytes is below the calibrated {calibration['bytes_per_token']:.2f} bytes per token / {self.margin}, lowering it")
+            calibration["bytes_per_token"] = ratio
+            self.save_calibration(dataset)
+        else:
+            return False
+        return True
+
+
+    def pop_stats(self):
+        stats = {"checked": dict(self.checked), "skipped": dict(self.skipped), "observed": self.observed}
+        self.checked, self.skipped, self.observed = defaultdict(int), defaultdict(int), []
+        return stats
+
+
+    def merge_stats(self, stats):
+        for dataset, n in stats["checked"].items():
+            self.checked[dataset] += n
+        for dataset, n in stats["skipped"].items():
+            self.skipped[dataset] += n
+        for dataset, profile, num_tokens in stats["observed"]:
+            self.add_sample(dataset, profile, num_tokens)
+
+
+    def log_stats(self):
+        for dataset in self.checked:
+            logger.info(f"Length pre-check for {dataset}: skipped the exact tokenization for {self.skipped[dataset]}/{self.checked[dataset]} prompts")
+        self.checked, self.skipped = defaultdict(int), defaultdict(int)
+
+
+class EndpointBalancer:
+    """
+    Client-side load balancer over several OpenAI-compatible endpoints (e.g., multiple vLLM replicas).
+    It exposes the same `chat.completions.create` and `completions.create` calls as the OpenAI client, so it can be used in place of one.
+    Each call is routed to the healthy endpoint with the fewest outstanding requests (or outstanding input characters, a proxy for tokens).
+    An endpoint is taken out of rotation after max_failures consecutive failures, and is put back once a probe (listing the models) succeeds.
+    """
+    def __init__(self, endpoint_urls: List[str], api_key: str, balance_by: str="requests", max_failures: int=3, probe_interval: int=30):
+        from openai import OpenAI
+        self.endpoint_urls = endpoint_urls
+        self.clients = [OpenAI(base_url=url, api_key=api_key) for url in endpoint_urls]
+        self.balance_by = balance_by
+        self.max_failures = max_failures
+        self.probe_interval = probe_interval
+
+        self.outstanding = [0 for _ in endpoint_urls]
+        self.outstanding_chars = [0 for _ in endpoint_urls]
+        self.failures = [0 for _ in endpoint_urls]
+        self.healthy = [True for _ in endpoint_urls]
+        self.next_probe = [0 for _ in endpoint_urls]
+        self.lock = threading.Lock()
+
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=functools.partial(self._call, lambda client: client.chat.completions.create)))
+        self.completions = SimpleNamespace(create=functools.partial(self._call, lambda client: client.completions.create))
+
+
+    def _probe(self, idx):
+        # only one thread probes an endpoint at a time, the others wait for the next interval
+        with self.lock:
+            if self.healthy[idx] or time.time() < self.next_probe[idx]:
+                return
+            self.next_probe[idx] = time.time() + self.probe_interval
+        try:
+            self.clients[idx].with_options(timeout=10, max_retries=0).models.list()
+        except Exception as e:
+            logger.info(f"Probe to {self.endpoint_urls[idx]} failed: {e}")
+            return
+        with self.lock:
+            self.healthy[idx] = True
+            self.failures[idx] = 0
+        logger.info(f"{self.endpoint_urls[idx]} is healthy again, putting it back into rotation")
+
+
+    def _acquire(self, size):
+        for idx in range(len(self.clients)):
+            if not self.healthy[idx]:
+                self._probe(idx)
+
+        with self.lock:
+            candidates = [idx for idx in range(len(self.clients)) if self.healthy[idx]]
+            if len(candidates) == 0:
+                # better to keep trying than to fail every request
+                candidates = list(range(len(self.clients)))
+            if self.balance_by == "tokens":
+                idx = min(candidates, key=lambda i: (self.outstanding_chars[i], self.outstanding[i]))
+            else:
+                idx = min(candidates, key=lambda i: (self.outstanding[i], self.outstanding_chars[i]))
+            self.outstanding[idx] += 1
+            self.outstanding_chars[idx] += size
+        return idx
+
+
+    def _release(self, idx, size, error=None):
+        with self.lock:
+            self.outstanding[idx] -= 1
+            self.outstanding_chars[idx] -= size
+            if error is None:
+                self.failures[idx] = 0
+                return
+            msg = str(error).lower()
+            if "rate limit" in msg or "rate_limit" in msg or "429" in msg:
+                # the endpoint is busy but not broken
+                return
+            self.failures[idx] += 1
+            if self.healthy[idx] and self.failures[idx] >= self.max_failures:
+                self.healthy[idx] = False
+                self.next_probe[idx] = time.time() + self.probe_interval
+                logger.warning(f"{self.endpoint_urls[idx]} failed {self.failures[idx]} times in a row, taking it out of rotation")
+
+
+    def _call(self, get_func, **kwargs):
+        size = get_input_length(kwargs.get("messages", kwargs.get("prompt", None)))
+        idx = self._acquire(size)
+        try:
+            start_time = time.time()
+            output = get_func(self.clients[idx])(**kwargs)
+            if kwargs.get("stream", False):
+                # consume the stream here, so the request stays outstanding until it finishes and errors mid-stream count as failures
+                output = collect_stream(output, start_time)
+        except Exception as e:
+            self._release(idx, size, error=e)
+            raise e
+        self._release(idx, size)
+        return output
+
+
 class LLM:
     """
     Base class for generative models.
@@ -109,6 +655,10 @@ class LLM:
         self.system_message = system_message
         self.stops = None
         self.thinking = False
+        # the order in which the requests are submitted in generate_batch, see order_by_length
+        self.ordering = "original"
+        # whether to stream the outputs (if supported), which allows us to measure the time to first token
+        self.stream = False
         if stop_new_line:
             self.stops = ["\n", "\n\n"]
 
@@ -125,6 +675,13 @@ class LLM:
     def prepare_inputs(self, test_item: Dict[str, Any], data: Dict[str, Any]) -> Any:
         raise NotImplementedError("prepare_inputs not implemented for LLM")
 
+    """
+    Prepare a contiguous chunk of test items at once (see data.prepare_all_inputs).
+    The children class can override this to share the work across the items, e.g., tokenizing all the contexts in one batched call.
+    """
+    def prepare_inputs_batch(self, test_items: List[Dict[str, Any]], data: Dict[str, Any]) -> List[Any]:
+        return [self.prepare_inputs(test_item, data) for test_item in test_items]
+
     """
     Generate the output from the model
 
@@ -151,15 +708,58 @@ class LLM:
     The children classes may override this function for optimization.
     """
     def generate_batch(self, inputs: Optional[List[Any]]=None, prompt: Optional[List[str]]=None, **kwargs) -> List[Optional[Dict[str, Any]]]:
-        outputs = []
-        if inputs is None:
-            for p in tqdm(prompt):
-                outputs.append(self.generate(prompt=p, **kwargs))
-        else:
-            for i in tqdm(inputs):
-                outputs.append(self.generate(inputs=i, **kwargs))
+        outputs = [None for _ in (inputs if inputs is not None else prompt)]
+        for idx, output in self.generate_iter(inputs=inputs, prompt=prompt, **kwargs):
+            outputs[idx] = output
         return outputs
 
+    """
+    Generate the outputs for a list of inputs or prompts, but yield (index, output) as soon as each output is ready.
+    This allows the caller to start post-processing while the rest of the generation is still running.
+    The outputs may be yielded out of order, so the index should be used to map them back to the inputs.
+
+    The children classes may override this function if they can return outputs before the whole batch is done.
+    """
+    def generate_iter(self, inputs: Optional[List[Any]]=None, prompt: Optional[List[str]]=None, **kwargs):
+        submit_time = time.time()
+        for idx in tqdm(self.get_submission_order(inputs, prompt)):
+            start_time = time.time()
+            if inputs is None:
+                output = self.generate(prompt=prompt[idx], **kwargs)
+            else:
+                output = self.generate(inputs=inputs[idx], **kwargs)
+            yield idx, add_telemetry(output, submit_time, start_time, time.time())
+
+    """
+    Score the candidate continuations of each input (e.g., the labels of a classification task) by their log-likelihood instead of generating.
+    continuations is a list with the candidate strings of each input, and the outputs are yielded as (index, output) like generate_iter,
+    where "output" is the most likely continuation and "candidate_logprobs" are the log-likelihoods of all the candidates.
+    Only the children classes with supports_scoring implement this.
+    """
+    supports_scoring = False
+
+    def score_iter(self, inputs: List[Any], continuations: List[List[str]]):
+        submit_time = time.time()
+        for idx in tqdm(self.get_submission_order(inputs)):
+            start_time = time.time()
+            output = self.score_candidates(inputs[idx], continuations[idx])
+            yield idx, add_telemetry(output, submit_time, start_time, time.time())
+
+    def score_candidates(self, inputs: Any, continuations: List[str]) -> Dict[str, Any]:
+        raise NotImplementedError("score_candidates not implemented for LLM")
+
+    """
+    Get the order in which the inputs (or prompts) are submitted, according to the self.ordering policy.
+    """
+    def get_submission_order(self, inputs: Optional[List[Any]]=None, prompt: Optional[List[str]]=None) -> List[int]:
+        items = inputs if inputs is not None else prompt
+        order = getattr(self, "submission_order", None)
+        if order is not None and len(order) == len(items):
+            # the caller already computed the order of these inputs (see eval.generate_pending), it is only used once
+            self.submission_order = None
+            return order
+        return get_request_order(items, getattr(self, "ordering", "original"))
+
 
 class OpenAIModel(LLM):
     def __init__(
@@ -194,7 +794,8 @@ class OpenAIModel(LLM):
         )
         import openai
         import tiktoken
-        if "azure" in model_name:
+        self.is_azure = "azure" in model_name
+        if self.is_azure:
             # env var: AZURE_OPENAI_API_KEY, AZURE_OPENAI_ENDPOINT, and OPENAI_API_VERSION
             self.model = openai.AzureOpenAI()
             model_name = model_name[model_name.index("/")+1:]
@@ -203,6 +804,7 @@ class OpenAIModel(LLM):
             self.model = openai.OpenAI()
         self.model_name = model_name
         self.tokenizer = tiktoken.encoding_for_model(model_name)
+        self.length_precheck = LengthPrecheck(model_name)
         self.seed = seed
         self.API_MAX_LENGTH = 128000 # this is defined by the OPENAI API
         self.use_completions_api = use_completions_api
@@ -217,12 +819,15 @@ class OpenAIModel(LLM):
         else:
             prompt = format_chat(data["user_template"].format(**test_item), system_message=self.system_message)
         inputs = "\n".join([f"Role: {x['role']}\nContent: {x['content']}" for x in prompt])
-        tokens = self.tokenizer.encode(inputs)
-        input_len = len(tokens)
-
         if self.max_length > self.API_MAX_LENGTH:
             logger.warning(f"max_length {self.max_length} is greater than {self.API_MAX_LENGTH}, setting to {self.API_MAX_LENGTH}")
             self.max_length = self.API_MAX_LENGTH
+        if self.length_precheck.is_under_budget(data.get("dataset"), inputs, self.max_length - self.generation_max_length - buffer):
+            return prompt
+
+        tokens = self.tokenizer.encode(inputs)
+        input_len = len(tokens)
+        self.length_precheck.update(data.get("dataset"), inputs, input_len)
 
         if input_len > self.max_length - self.generation_max_length - buffer:
             truncate_length = input_len - (self.max_length - self.generation_max_length - buffer)
@@ -239,11 +844,27 @@ class OpenAIModel(LLM):
         return prompt
 
 
-    def generate(self, inputs=None, prompt=None, **kwargs):
+    def build_request(self, inputs=None, prompt=None, **kwargs):
+        """
+        Build the API request for the given inputs, this is shared by the synchronous (generate) and the async (agenerate) paths.
+        Returns a function that gets the create method from a client, the request parameters, and a function that parses the response.
+        """
         if inputs is None:
             # for system_message, set the self.system_message attribute
             inputs = format_chat(prompt, system_message=self.system_message)
-        
+
+        def parse_chat(output):
+            if output.choices[0].message.content is None:
+                # sometimes the model output can get filtered but still return a message
+                return None
+            return {
+                "output": output.choices[0].message.content,
+                "input_len": output.usage.prompt_tokens,
+                "output_len": output.usage.completion_tokens,
+                "input_text": inputs,
+                "system_fingerprint": output.system_fingerprint,
+            }
+
         if "FD_eval" in self.model_name: # 大多数vllm评估不走这个分支
             # 如果是 FastDeploy格式的API，将会直接使用 chat template格式来模拟 completion API
             # 将 chat messages 转换为单个 prompt 字符串
@@ -276,8 +897,7 @@ class OpenAIModel(LLM):
             kwargs["metadata"] = meta_data
             
             # kwargs can be used to pass additional parameters to the model: max_tokens, stop, etc.
-            func = functools.partial(
-                self.model.chat.completions.create,
+            params = dict(
                 model=self.model_name,
                 messages=message,
                 max_tokens=self.generation_max_length,
@@ -288,20 +908,7 @@ class OpenAIModel(LLM):
                 reasoning_effort=getattr(self, "reasoning_effort", None),
                 **kwargs,
             )
-            output = call_api(func)
-            # print(output)
-            if output is not None:
-                if output.choices[0].message.content is None:
-                    # sometimes the model output can get filtered but still return a message
-                    return None
-                return {
-                    "output": output.choices[0].message.content,
-                    "input_len": output.usage.prompt_tokens,
-                    "output_len": output.usage.completion_tokens,
-                    "input_text": inputs,
-                    "system_fingerprint": output.system_fingerprint,
-                }
-            return None
+            return (lambda client: client.chat.completions.create), params, parse_chat
 
         else:
             if self.use_completions_api:
@@ -313,8 +920,7 @@ class OpenAIModel(LLM):
                 else:
                     prompt_text = inputs
                 
-                func = functools.partial(
-                    self.model.completions.create,
+                params = dict(
                     model=self.model_name,
                     prompt=prompt_text,
                     max_tokens=self.generation_max_length,
@@ -324,9 +930,8 @@ class OpenAIModel(LLM):
                     seed=self.seed,
                     **kwargs,
                 )
-                output = call_api(func)
-                
-                if output is not None:
+
+                def parse_completion(output):
                     if output.choices[0].text is None:
                         return None
                     return {
@@ -336,7 +941,7 @@ class OpenAIModel(LLM):
                         "input_text": prompt_text,
                         "system_fingerprint": getattr(output, "system_fingerprint", None),
                     }
-                return None
+                return (lambda client: client.completions.create), params, parse_completion
             else:
                 # HACK： Hard code 关闭think
                 if self.thinking == False:
@@ -355,8 +960,7 @@ class OpenAIModel(LLM):
                         log_once("[HACK] vllm request 注入 \"enable_thinking\": False ")
                 
                 # kwargs can be used to pass additional parameters to the model: max_tokens, stop, etc.
-                func = functools.partial(
-                    self.model.chat.completions.create,
+                params = dict(
                     model=self.model_name,
                     messages=inputs,
                     max_tokens=self.generation_max_length,
@@ -367,20 +971,67 @@ class OpenAIModel(LLM):
                     reasoning_effort=getattr(self, "reasoning_effort", None),
                     **kwargs,
                 )
-                output = call_api(func)
-                # print(output)
-                if output is not None:
-                    if output.choices[0].message.content is None:
-                        # sometimes the model output can get filtered but still return a message
-                        return None
-                    return {
-                        "output": output.choices[0].message.content,
-                        "input_len": output.usage.prompt_tokens,
-                        "output_len": output.usage.completion_tokens,
-                        "input_text": inputs,
-                        "system_fingerprint": output.system_fingerprint,
-                    }
-                return None
+                return (lambda client: client.chat.completions.create), params, parse_chat
+
+
+    def generate(self, inputs=None, prompt=None, **kwargs):
+        get_create, params, parse = self.build_request(inputs=inputs, prompt=prompt, **kwargs)
+        if getattr(self, "stream", False):
+            # streaming gives us the time to first token, the whole stream is consumed inside call_api so that errors are retried
+            create = get_create(self.model)
+            def func():
+                start_time = time.time()
+                output = create(**params, stream=True, stream_options={"include_usage": True})
+                # the balancer already collects the stream itself
+                return output if isinstance(self.model, EndpointBalancer) else collect_stream(output, start_time)
+        else:
+            func = functools.partial(get_create(self.model), **params)
+        output = call_api(func)
+        # print(output)
+        if output is not None:
+            result = self.fill_missing_usage(parse(output))
+            if result is not None and getattr(output, "ttft", None) is not None:
+                result["ttft"] = output.ttft
+            return result
+        return None
+
+
+    def fill_missing_usage(self, result):
+        # the streams of some providers do not return the usage, so the input tokens are counted locally
+        if result is not None and result.get("input_len") is None:
+            input_text = result["input_text"]
+            if not isinstance(input_text, str):
+                input_text = "\n".join([str(x.get("content", "")) for x in input_text])
+            result["input_len"] = len(self.tokenizer.encode(input_text))
+        return result
+
+
+    async def agenerate(self, inputs=None, prompt=None, client=None, **kwargs):
+        """
+        The same as generate, but uses an async client (see create_async_client) so that many requests can be in flight on one event loop.
+        """
+        get_create, params, parse = self.build_request(inputs=inputs, prompt=prompt, **kwargs)
+        if getattr(self, "stream", False):
+            create = get_create(client)
+            async def func():
+                start_time = time.time()
+                return await collect_stream_async(await create(**params, stream=True, stream_options={"include_usage": True}), start_time)
+        else:
+            func = functools.partial(get_create(client), **params)
+        output = await call_api_async(func)
+        if output is not None:
+            result = self.fill_missing_usage(parse(output))
+            if result is not None and getattr(output, "ttft", None) is not None:
+                result["ttft"] = output.ttft
+            return result
+        return None
+
+
+    def create_async_client(self):
+        import openai
+        if self.is_azure:
+            return openai.AsyncAzureOpenAI()
+        return openai.AsyncOpenAI()
 
     def batch_api(self, inputs, batch_file, **kwargs):
         with open(batch_file, "w") as f:
@@ -462,19 +1113,38 @@ class OpenAIModel(LLM):
                     outputs.extend(self.batch_api(inputs[i:i+batch_size], batch_file, **kwargs))
 
         else:
-            if inputs is None:
-                inputs = [None for _ in prompt]
-            else:
-                prompt = [None for _ in inputs]
-
-            # we don't support kwargs here for now
-            if len(kwargs) > 0:
-                logger.warning("kwargs are not supported for batch generation")
-            # use thread_map instead of process_map since the bottleneck is the api call
-            outputs = thread_map(self.generate, inputs, prompt, max_workers=32)
+            outputs = [None for _ in (inputs if inputs is not None else prompt)]
+            for idx, output in self.generate_iter(inputs=inputs, prompt=prompt, **kwargs):
+                outputs[idx] = output
 
         return outputs
 
+
+    def generate_iter(self, inputs=None, prompt=None, **kwargs):
+        if kwargs.get("batch_file", None):
+            # the batch api only returns once the whole batch is done
+            for idx, output in enumerate(self.generate_batch(inputs=inputs, prompt=prompt, **kwargs)):
+                yield idx, output
+            return
+
+        kwargs.pop("batch_file", None)
+        order = self.get_submission_order(inputs, prompt)
+        if inputs is None:
+            inputs = [None for _ in prompt]
+        else:
+            prompt = [None for _ in inputs]
+
+        # we don't support kwargs here for now
+        if len(kwargs) > 0:
+            logger.warning("kwargs are not supported for batch generation")
+        if getattr(self, "use_async", False):
+            # one event loop with many requests in flight instead of a thread per request
+            func = functools.partial(self.agenerate, client=self.create_async_client())
+            yield from async_imap(func, inputs, prompt, max_concurrency=self.max_concurrency, order=order)
+            return
+        # use threads instead of processes since the bottleneck is the api call
+        yield from thread_imap(self.generate, inputs, prompt, max_workers=32, order=order)
+
 class TgiVllmModel(OpenAIModel):
     def __init__(
         self, 
@@ -518,11 +1188,18 @@ class TgiVllmModel(OpenAIModel):
         
         endpoint_url = kwargs["endpoint_url"]
         print(f"** Endpoint URL: {endpoint_url}")
+        self.endpoint_url = endpoint_url
+        self.api_key = kwargs["api_key"]
 
-        self.model = OpenAI(
-                base_url=endpoint_url,
-                api_key=kwargs["api_key"],
-            )
+        # multiple replicas can be given as a comma separated list, in which case we balance the requests across them
+        endpoint_urls = [url.strip() for url in endpoint_url.split(",") if url.strip() != ""]
+        if len(endpoint_urls) > 1:
+            self.model = EndpointBalancer(endpoint_urls, api_key=kwargs["api_key"], balance_by=kwargs.get("balance_by", "requests"))
+        else:
+            self.model = OpenAI(
+                    base_url=endpoint_url,
+                    api_key=kwargs["api_key"],
+                )
         if "tgi" in model_name:
             # remove the tgi: prefix
             model_name = model_name[model_name.index(":")+1:]
@@ -537,6 +1214,16 @@ class TgiVllmModel(OpenAIModel):
         self.API_MAX_LENGTH = float('inf')
 
     def generate_batch(self, inputs=None, prompt=None, **kwargs):
+        outputs = [None for _ in (inputs if inputs is not None else prompt)]
+        for idx, output in self.generate_iter(inputs=inputs, prompt=prompt, **kwargs):
+            outputs[idx] = output
+        # print(inputs)
+        # print(outputs)
+        return outputs
+
+
+    def generate_iter(self, inputs=None, prompt=None, **kwargs):
+        order = self.get_submission_order(inputs, prompt)
         if inputs is None:
             inputs = [None for _ in prompt]
         else:
@@ -545,13 +1232,23 @@ class TgiVllmModel(OpenAIModel):
         # we don't support kwargs here for now
         if len(kwargs) > 0:
             logger.warning("kwargs are not supported for batch generation")
-        # use thread_map instead of process_map since the bottleneck is the api call
+        # use threads instead of processes since the bottleneck is the api call
+        if getattr(self, "use_async", False):
+            if isinstance(self.model, EndpointBalancer):
+                logger.warning("the async path does not support multiple endpoints yet, using threads instead")
+            else:
+                # one event loop with many requests in flight instead of a thread per request
+                func = functools.partial(self.agenerate, client=self.create_async_client())
+                yield from async_imap(func, inputs, prompt, max_concurrency=self.max_concurrency, order=order)
+                return
         # HACK: max_worker 32=> 100
         max_workers = int(os.getenv("MAX_WORKERS", "32"))
-        outputs = thread_map(self.generate, inputs, prompt, max_workers=max_workers)
-        # print(inputs)
-        # print(outputs)
-        return outputs
+        yield from thread_imap(self.generate, inputs, prompt, max_workers=max_workers, order=order)
+
+
+    def create_async_client(self):
+        from openai import AsyncOpenAI
+        return AsyncOpenAI(base_url=self.endpoint_url, api_key=self.api_key)
 
 
 class AnthropicModel(LLM):
@@ -582,7 +1279,8 @@ class AnthropicModel(LLM):
             system_message=system_message,
         )
         from anthropic import Anthropic, AnthropicVertex
-        if "vertex" in model_name:
+        self.is_vertex = "vertex" in model_name
+        if self.is_vertex:
             # region defaults to env var CLOUD_ML_REGION and project_id defaults to ANTHROPIC_VERTEX_PROJECT_ID
             self.model = AnthropicVertex()
             model_name = model_name[model_name.index("/")+1:]
@@ -595,6 +1293,7 @@ class AnthropicModel(LLM):
         # https://github.com/anthropics/anthropic-sdk-python/blob/12dbc0c315eee4117c337da99beea5c53d898f9b/src/anthropic/tokenizer.json
         from tokenizers import Tokenizer
         self.tokenizer = Tokenizer.from_file("claude.tokenizer.json")
+        self.length_precheck = LengthPrecheck("claude")
         self.model_name = model_name
         self.temperature = temperature
         self.top_p = top_p
@@ -614,8 +1313,11 @@ class AnthropicModel(LLM):
         # for anthropic, the system message is passed through the function not in the prompt
         prompt = format_chat(data["user_template"].format(**test_item), system_message=None)
         inputs = "\n".join([f"Role: {x['role']}\nContent: {x['content']}" for x in prompt])
+        if self.length_precheck.is_under_budget(data.get("dataset"), inputs, self.max_length - self.generation_max_length - buffer):
+            return prompt
         tokens = self.tokenizer.encode(inputs)
         input_len = len(tokens)
+        self.length_precheck.update(data.get("dataset"), inputs, input_len)
 
         if input_len > self.max_length - self.generation_max_length - buffer:
             truncate_length = input_len - (self.max_length - self.generation_max_length - buffer)
@@ -626,7 +1328,11 @@ class AnthropicModel(LLM):
         return prompt
 
 
-    def generate(self, inputs=None, prompt=None, **kwargs):
+    def build_request(self, inputs=None, prompt=None, **kwargs):
+        """
+        Build the API request for the given inputs, this is shared by the synchronous (generate) and the async (agenerate) paths.
+        Returns the inputs and the request parameters.
+        """
         if inputs is None:
             inputs = format_chat(prompt, system_message=None)
 
@@ -635,9 +1341,7 @@ class AnthropicModel(LLM):
         # system="You are a helpful assistant. Make sure your output does not contain new lines."
         # To be consistent with the other models, and for future compability, we remove the system message
         # We don't expect this to make a significant difference in the results
-        print(inputs)
-        func = functools.partial(
-            self.model.messages.create,
+        params = dict(
             model=self.model_name,
             messages=inputs,
             max_tokens=self.generation_max_length,
@@ -647,18 +1351,47 @@ class AnthropicModel(LLM):
             system=self.system_message,
             **kwargs,
         )
-        output = call_api(func, pause=20)
+        return inputs, params
+
+
+    def parse_output(self, output, inputs):
+        return {
+            "output": output.content[0].text,
+            "input_len": output.usage.input_tokens,
+            "output_len": output.usage.output_tokens,
+            "input_text": inputs,
+        }
+
+
+    def generate(self, inputs=None, prompt=None, **kwargs):
+        inputs, params = self.build_request(inputs=inputs, prompt=prompt, **kwargs)
+        print(inputs)
+        output = call_api(functools.partial(self.model.messages.create, **params), pause=20)
 
         if output is not None:
-            return {
-                "output": output.content[0].text,
-                "input_len": output.usage.input_tokens,
-                "output_len": output.usage.output_tokens,
-                "input_text": inputs,
-            }
+            return self.parse_output(output, inputs)
+        return None
+
+
+    async def agenerate(self, inputs=None, prompt=None, client=None, **kwargs):
+        """
+        The same as generate, but uses an async client (see create_async_client) so that many requests can be in flight on one event loop.
+        """
+        inputs, params = self.build_request(inputs=inputs, prompt=prompt, **kwargs)
+        output = await call_api_async(functools.partial(client.messages.create, **params), pause=20)
+
+        if output is not None:
+            return self.parse_output(output, inputs)
         return None
 
 
+    def create_async_client(self):
+        from anthropic import AsyncAnthropic, AsyncAnthropicVertex
+        if self.is_vertex:
+            return AsyncAnthropicVertex()
+        return AsyncAnthropic()
+
+
     def batch_api(self, inputs, **kwargs):
         # this should be faster and costs 50%, but each batch cannot exceed 100k requests or 256MB
         # https://docs.anthropic.com/en/docs/build-with-claude/message-batches
@@ -720,20 +1453,39 @@ class AnthropicModel(LLM):
                     outputs.extend(self.batch_api(inputs[i:i+batch_size], batch_file, **kwargs))
 
         else:
-            if inputs is None:
-                inputs = [None for _ in prompt]
-            else:
-                prompt = [None for _ in inputs]
-
-            # we don't support kwargs here for now
-            if len(kwargs) > 0:
-                logger.warning("kwargs are not supported for batch generation")
-            # use thread_map instead of process_map since the bottleneck is the api call
-            outputs = thread_map(self.generate, inputs, prompt, max_workers=2)
+            outputs = [None for _ in (inputs if inputs is not None else prompt)]
+            for idx, output in self.generate_iter(inputs=inputs, prompt=prompt, **kwargs):
+                outputs[idx] = output
 
         return outputs
 
 
+    def generate_iter(self, inputs=None, prompt=None, **kwargs):
+        if kwargs.get("batch_file", None):
+            # the batch api only returns once the whole batch is done
+            for idx, output in enumerate(self.generate_batch(inputs=inputs, prompt=prompt, **kwargs)):
+                yield idx, output
+            return
+
+        kwargs.pop("batch_file", None)
+        order = self.get_submission_order(inputs, prompt)
+        if inputs is None:
+            inputs = [None for _ in prompt]
+        else:
+            prompt = [None for _ in inputs]
+
+        # we don't support kwargs here for now
+        if len(kwargs) > 0:
+            logger.warning("kwargs are not supported for batch generation")
+        if getattr(self, "use_async", False):
+            # one event loop with many requests in flight instead of a thread per request
+            func = functools.partial(self.agenerate, client=self.create_async_client())
+            yield from async_imap(func, inputs, prompt, max_concurrency=self.max_concurrency, order=order)
+            return
+        # use threads instead of processes since the bottleneck is the api call
+        yield from thread_imap(self.generate, inputs, prompt, max_workers=2, order=order)
+
+
 class GeminiModel(LLM):
     def __init__(
         self,
@@ -771,6 +1523,7 @@ class GeminiModel(LLM):
         from vertexai.preview.tokenization import get_tokenizer_for_model
         self.model = genai.GenerativeModel(model_name)
         self.tokenizer = get_tokenizer_for_model(model_name)
+        self.length_precheck = LengthPrecheck(model_name)
         self.model_name = model_name
         if system_message is not None:
             logger.warning("system_message is not supported for GeminiModel")
@@ -779,8 +1532,11 @@ class GeminiModel(LLM):
     def prepare_inputs(self, test_item, data):
         prompt = data["prompt_template"].format(**test_item)
         buffer = 100
+        if self.length_precheck.is_under_budget(data.get("dataset"), prompt, self.max_length - self.generation_max_length - buffer):
+            return prompt
         inputs = self.tokenizer.compute_tokens(prompt).token_info_list()[0].tokens
         input_len = len(inputs)
+        self.length_precheck.update(data.get("dataset"), prompt, input_len)
 
         max_length = self.max_length
         if input_len > max_length - self.generation_max_length - buffer:
@@ -826,6 +1582,15 @@ class GeminiModel(LLM):
 
 
     def generate_batch(self, inputs=None, prompt=None, **kwargs):
+        outputs = [None for _ in (inputs if inputs is not None else prompt)]
+        for idx, output in self.generate_iter(inputs=inputs, prompt=prompt, **kwargs):
+            outputs[idx] = output
+
+        return outputs
+
+
+    def generate_iter(self, inputs=None, prompt=None, **kwargs):
+        order = self.get_submission_order(inputs, prompt)
         if inputs is None:
             inputs = [None for _ in prompt]
         else:
@@ -834,10 +1599,8 @@ class GeminiModel(LLM):
         # we don't support kwargs here for now
         if len(kwargs) > 0:
             logger.warning("kwargs are not supported for batch generation")
-        # use thread_map instead of process_map since the bottleneck is the api call
-        outputs = thread_map(self.generate, inputs, prompt, max_workers=32)
-
-        return outputs
+        # use threads instead of processes since the bottleneck is the api call
+        yield from thread_imap(self.generate, inputs, prompt, max_workers=32, order=order)
 
 
 class TogetherModel(LLM):
@@ -881,19 +1644,24 @@ class TogetherModel(LLM):
             "deepseek-ai/DeepSeek-R1": "deepseek-ai/DeepSeek-R1",
         }
         self.tokenizer = AutoTokenizer.from_pretrained(name_mapping[self.model_name])
+        self.length_precheck = LengthPrecheck(name_mapping[self.model_name])
 
 
     def prepare_inputs(self, test_item, data):
         buffer = 100
         prompt = format_chat(data["user_template"].format(**test_item), system_message=self.system_message)
+        text = "\n".join([x["content"] for x in prompt])
+        if self.length_precheck.is_under_budget(data.get("dataset"), text, self.max_length - self.generation_max_length - buffer):
+            return prompt
         tokens = self.tokenizer.apply_chat_template(prompt, tokenize=True, add_generation_prompt=True)
         input_len = len(tokens)
+        self.length_precheck.update(data.get("dataset"), text, input_len)
 
         max_length = self.max_length
         if input_len > max_length - self.generation_max_length - buffer:
             truncate_length = input_len - (max_length - self.generation_max_length - buffer)
-            context_tokens = self.tokenizer(test_item["context"], return_offsets_mapping=True)
-            new_context = test_item["context"][:context_tokens["offset_mapping"][-truncate_length][0]]
+            offsets = get_token_offsets(self.tokenizer, test_item["context"])
+            new_context = test_item["context"][:offsets[-truncate_length][0]]
 
             test_item["context"] = new_context
             prompt = format_chat(data["user_template"].format(**test_item), system_message=self.system_message)
@@ -930,6 +1698,15 @@ class TogetherModel(LLM):
 
 
     def generate_batch(self, inputs=None, prompt=None, **kwargs):
+        outputs = [None for _ in (inputs if inputs is not None else prompt)]
+        for idx, output in self.generate_iter(inputs=inputs, prompt=prompt, **kwargs):
+            outputs[idx] = output
+
+        return outputs
+
+
+    def generate_iter(self, inputs=None, prompt=None, **kwargs):
+        order = self.get_submission_order(inputs, prompt)
         if inputs is None:
             inputs = [None for _ in prompt]
         else:
@@ -938,10 +1715,98 @@ class TogetherModel(LLM):
         # we don't support kwargs here for now
         if len(kwargs) > 0:
             logger.warning("kwargs are not supported for batch generation")
-        # use thread_map instead of process_map since the bottleneck is the api call
-        outputs = thread_map(self.generate, inputs, prompt, max_workers=32)
+        # use threads instead of processes since the bottleneck is the api call
+        yield from thread_imap(self.generate, inputs, prompt, max_workers=32, order=order)
 
-        return outputs
+
+# whether each tokenizer keeps the tokens from merging across a segment boundary, keyed by tokenizer id
+segments_supported = {}
+
+
+def supports_segments(tokenizer) -> bool:
+    """
+    Whether tokenize_by_segments can apply to the tokenizer, checked once per tokenizer on a few typical boundaries.
+    Sentencepiece tokenizers fail here, as they add a prefix space to every segment.
+    The check is repeated on the actual boundaries of each prompt, this only saves the work that would be thrown away.
+    """
+    key = id(tokenizer)
+    if key not in segments_supported:
+        def encode(text):
+            return tokenizer(text, add_special_tokens=False)["input_ids"]
+        probes = [("Document:\n\n", "The text"), ("\n", "x"), ("Question: ", "What")]
+        segments_supported[key] = getattr(tokenizer, "is_fast", False) and all(encode(left + right) == encode(left) + encode(right) for left, right in probes)
+        if not segments_supported[key]:
+            logger.info("The tokenizer merges tokens across the segment boundaries, tokenizing the whole prompts instead")
+    return segments_supported[key]
+
+
+def prefetch_encodings(tokenizer, texts: List[str]) -> Dict[str, Any]:
+    """
+    Encode the texts in one batch with the fast tokenizer, which runs the batch in parallel in Rust, so tokenize_by_segments does not have to encode them one at a time.
+    Returns the encodings keyed by text, or nothing if tokenize_by_segments cannot use them for this tokenizer.
+    """
+    if len(texts) == 0 or not supports_segments(tokenizer):
+        return {}
+    texts = list(dict.fromkeys(texts))
+    return dict(zip(texts, tokenizer.backend_tokenizer.encode_batch(texts, add_special_tokens=False)))
+
+
+def tokenize_by_segments(sample: Dict[str, Any], format_prompt: Callable, tokenizer, budget: int, window: int=64, encodings: Optional[Dict[str, Any]]=None):
+    """
+    Tokenize the prompt as three segments: the template before the context, the context, and the template after it.
+    Each segment is tokenized once and the context tokens are cut to fit the budget exactly, instead of tokenizing the whole prompt, the context, and then the whole prompt again.
+    This is only exact if the tokens do not merge across the segment boundaries, which is checked on a small window around each boundary;
+    returns None when it is not exact (e.g., sentencepiece tokenizers that add a prefix space to every segment) so the caller falls back to tokenizing the whole prompt.
+    The context may already be encoded in encodings (see prefetch_encodings).
+    """
+    if "context" not in sample or not supports_segments(tokenizer):
+        return None
+    sentinel = "<|helmet_context_placeholder|>"
+    prompt, add_special_tokens = format_prompt({**sample, "context": sentinel})
+    if prompt.count(sentinel) != 1:
+        return None
+    prefix, suffix = prompt.split(sentinel)
+    context = sample["context"]
+
+    # only a bos token (or nothing) can be added around the prompt
+    special_ids = tokenizer("", add_special_tokens=add_special_tokens)["input_ids"]
+    if len(special_ids) > 1 or (len(special_ids) == 1 and special_ids[0] != tokenizer.bos_token_id):
+        return None
+
+    def encode(text):
+        return tokenizer(text, add_special_tokens=False)["input_ids"]
+
+    def merges(left, right):
+        left, right = left[-window:], right[:window]
+        if len(left) == 0 or len(right) == 0:
+            return False
+        return encode(left + right) != encode(left) + encode(right)
+
+    if merges(prefix, context):
+        return None
+    prefix_ids, suffix_ids = encode(prefix), encode(suffix)
+    context_encoding = (encodings or {}).get(context)
+    if context_encoding is None:
+        context_encoding = tokenizer.backend_tokenizer.encode(context, add_special_tokens=False)
+    context_ids = context_encoding.ids
+
+    total_length = len(special_ids) + len(prefix_ids) + len(context_ids) + len(suffix_ids)
+    if total_length > budget:
+        keep = len(context_ids) - (total_length - budget)
+        if keep <= 0:
+            return None
+        # cut the text at the end of the last kept token, and make sure the last few tokens are the same when the truncated context is tokenized again
+        context = context[:context_encoding.offsets[keep-1][1]]
+        context_ids = context_ids[:keep]
+        tail_start = context_encoding.offsets[max(keep-8, 0)][0]
+        if encode(context[tail_start:]) != context_ids[max(keep-8, 0):]:
+            return None
+    if merges(context, suffix):
+        return None
+
+    sample["context"] = context
+    input_ids = torch.tensor([special_ids + prefix_ids + context_ids + suffix_ids], dtype=torch.long)
+    return BatchEncoding({"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)})
 
 
 def tokenize(
@@ -953,6 +1818,7 @@ def tokenize(
     use_chat_template: bool=False,
     continue_final_message: bool=False,
     system_message: Optional[str]="You are a helpful assistant.",
+    encodings: Optional[Dict[str, Any]]=None,
 ):
     """
     Tokenize the input for HF-based models.
@@ -960,7 +1826,8 @@ def tokenize(
     if continue_final_message:
         assert use_chat_template
 
-    def format_input(sample):
+    def format_prompt(sample):
+        # returns the prompt and whether the tokenizer should add the special tokens (the chat template already has them)
         if use_chat_template:
             chat = format_chat(
                 data["user_template"].format(**sample),
@@ -977,18 +1844,22 @@ def tokenize(
                 if continue_final_message:
                     chat.append({"role": "assistant", "content": data['system_template'].format(**sample)})
                 prompt = tokenizer.apply_chat_template(chat, tokenize=False, add_generation_prompt=not continue_final_message, continue_final_message=continue_final_message)
+            return prompt, False
+        return data["prompt_template"].format(**sample), True
 
-            tokenized_input = tokenizer([prompt], return_tensors="pt", add_special_tokens=False)
-        else:
-            prompt = data["prompt_template"].format(**sample)
-            tokenized_input = tokenizer([prompt], return_tensors="pt")
-        return tokenized_input
+    def format_input(sample):
+        prompt, add_special_tokens = format_prompt(sample)
+        return tokenizer([prompt], return_tensors="pt", add_special_tokens=add_special_tokens)
 
     if "Phi3SmallTokenizer" in str(type(tokenizer)):
         buffer = 64 if max_length == 131072 else 0 # there is some problem with their rotary emb implementation
     else:
         buffer = 0
 
+    tokenized_input = tokenize_by_segments(sample, format_prompt, tokenizer, max_length - generation_max_length - buffer, encodings=encodings)
+    if tokenized_input is not None:
+        return tokenized_input
+
     tokenized_input = format_input(sample)
     if tokenized_input.input_ids.size(1) > max_length - generation_max_length - buffer:
         truncate_length = tokenized_input.input_ids.size(1) - (max_length - generation_max_length - buffer)
@@ -998,14 +1869,240 @@ def tokenize(
             context_tokens = tokenizer(sample["context"])
             new_context = tokenizer.decode(context_tokens["input_ids"][:-truncate_length])
         else:
-            context_tokens = tokenizer([sample["context"]], return_offsets_mapping=True)
-            new_context = sample["context"][:context_tokens["offset_mapping"][0][-truncate_length][0]]
+            # the offsets are indexed on disk, so the same document is only tokenized once (see token_index.py)
+            offsets = get_token_offsets(tokenizer, sample["context"])
+            new_context = sample["context"][:offsets[-truncate_length][0]]
 
         sample["context"] = new_context
         tokenized_input = format_input(sample)
     return tokenized_input
 
 
+def get_continuation_ids(tokenizer, input_ids, continuation: str) -> List[int]:
+    """
+    Tokenize the continuation of the prompt the same way as it would be tokenized after the prompt, by tokenizing it together with the last few prompt tokens.
+    """
+    tail = tokenizer.decode([int(t) for t in input_ids[-8:]], skip_special_tokens=False)
+    # the tail is compared with its own tokenization rather than with the prompt tokens, as the decoding drops the leading space of the sentencepiece tokens
+    tail_ids = tokenizer(tail, add_special_tokens=False)["input_ids"]
+    ids = tokenizer(tail + continuation, add_special_tokens=False)["input_ids"]
+    if ids[:len(tail_ids)] == tail_ids and len(ids) > len(tail_ids):
+        return ids[len(tail_ids):]
+    # the continuation merged with the end of the prompt, so we tokenize it on its own
+    return tokenizer(continuation, add_special_tokens=False)["input_ids"]
+
+
+def get_candidate_score(logprobs, ids: List[int], end_ids: List[int]) -> float:
+    """
+    The log-likelihood of the continuation ids followed by the end of the output (any of end_ids), where logprobs[k] are the log-probs of the next token after the first k ids.
+    Without the end, a candidate that is a prefix of another (e.g., "1" of "12" with the tokenizers that split the digits) would always score at least as high.
+    """
+    score = sum([float(logprobs[k][t]) for k, t in enumerate(ids)])
+    end = [float(logprobs[len(ids)][t]) for t in end_ids]
+    top = max(end)
+    if top == -math.inf:
+        return -math.inf
+    return score + top + math.log(sum([math.exp(x - top) for x in end]))
+
+
+def get_cache_size(past_key_values) -> int:
+    # the key and value tensors are stored differently across the transformers versions
+    if hasattr(past_key_values, "layers"):
+        tensors = [t for layer in past_key_values.layers for t in [getattr(layer, "keys", None), getattr(layer, "values", None)]]
+    elif hasattr(past_key_values, "key_cache"):
+        tensors = past_key_values.key_cache + past_key_values.value_cache
+    else:
+        tensors = [t for layer in past_key_values for t in layer]
+    return sum([t.numel() * t.element_size() for t in tensors if isinstance(t, torch.Tensor)])
+
+
+class SlotKVCache:
+    """
+    The kv cache of the continuous batching: a transformers StaticCache with one row (slot) per running sequence, allocated once for the whole run.
+    The rows are aligned on their last token: each decode step writes the new token of every row in place at the same column (position),
+    and a sequence is admitted by copying its prefilled cache into the columns right before it, so neither a step nor an admission copies the other rows.
+    mask (slots, capacity) marks the real tokens of each row. When position reaches the capacity, the columns are shifted left to the start of the oldest row,
+    which copies the cache once every slack steps at most.
+    """
+    def __init__(self, model, num_slots: int, max_prompt_len: int, max_new_tokens: int, slack: int=256):
+        from transformers import StaticCache
+        self.capacity = max_prompt_len + max_new_tokens + slack
+        self.cache = StaticCache(config=model.config, max_cache_len=self.capacity)
+        # an admitted prompt needs this many columns before the position
+        self.min_position = max_prompt_len
+        self.position = max_prompt_len
+        self.mask = torch.zeros(num_slots, self.capacity, dtype=torch.long, device=model.device)
+        self.lengths = torch.zeros(num_slots, dtype=torch.long, device=model.device)
+        self.active = torch.zeros(num_slots, dtype=torch.bool, device=model.device)
+
+
+    def is_supported(self):
+        """
+        Whether the cache has the layout this class writes into: the StaticLayer of transformers >= 4.56, lazily initialized,
+        which takes the write position from cache_position (4.x) or keeps it in cumulative_length (5.x).
+        The sliding window and chunked attention layers roll their cache, so their columns are not fixed.
+        """
+        layers = getattr(self.cache, "layers", None)
+        return layers is not None and all([type(layer).__name__ == "StaticLayer" and hasattr(layer, "is_initialized") and hasattr(layer, "lazy_initialization") for layer in layers])
+
+
+    def admit(self, slot: int, past_key_values, length: int):
+        """
+        Copy the cache of one prefilled sequence (length tokens) into the slot.
+        """
+        start = self.position - length
+        if length > 0:
+            for layer, (k, v) in zip(self.cache.layers, get_cache_layers(past_key_values)):
+                if not layer.is_initialized:
+                    # the signature changed from (keys) to (keys, values) in transformers 5
+                    init = [k.new_zeros(self.mask.size(0), *k.shape[1:]), v.new_zeros(self.mask.size(0), *v.shape[1:])]
+                    layer.lazy_initialization(*init[:len(inspect.signature(layer.lazy_initialization).parameters)])
+                layer.keys[slot, :, start:self.position] = k[0]
+                layer.values[slot, :, start:self.position] = v[0]
+        self.mask[slot] = 0
+        self.mask[slot, start:self.position] = 1
+        self.lengths[slot] = length
+        self.active[slot] = True
+
+
+    def release(self, slot: int):
+        self.mask[slot] = 0
+        self.active[slot] = False
+
+
+    def compact(self):
+        used = self.mask[self.active].any(dim=0).nonzero()
+        start = used[0].item() if len(used) > 0 else self.position
+        shift = min(start, self.position - self.min_position)
+        assert shift > 0, "the running sequences do not fit in the cache"
+        end = self.position - shift
+        for layer in self.cache.layers:
+            if layer.is_initialized:
+                layer.keys[:, :, :end] = layer.keys[:, :, shift:self.position].clone()
+                layer.values[:, :, :end] = layer.values[:, :, shift:self.position].clone()
+        self.mask[:, :end] = self.mask[:, shift:self.position].clone()
+        self.mask[:, end:] = 0
+        self.position = end
+
+
+    def step(self, model, input_ids):
+        """
+        Feed one token per slot (input_ids is (slots, 1)) and return the last logits. The free slots are fed too, so the shapes stay the same, but only see their own token.
+        """
+        if self.position == self.capacity:
+            self.compact()
+        self.mask[:, self.position] = 1
+        extra = {}
+        for layer in self.cache.layers:
+            if hasattr(layer, "cumulative_length"):
+                layer.cumulative_length.fill_(self.position)
+            else:
+                extra = {"cache_position": torch.tensor([self.position], device=self.mask.device)}
+        out = model(input_ids=input_ids, attention_mask=self.mask, position_ids=self.lengths.unsqueeze(1), past_key_values=self.cache, use_cache=True, **extra)
+        self.mask[~self.active, self.position] = 0
+        self.lengths += 1
+        self.position += 1
+        return out.logits[:, -1]
+
+
+def get_cache_layers(past_key_values):
+    # the (key, value) of each layer, the cache layout changed across the transformers versions
+    if hasattr(past_key_values, "layers"):
+        return [(layer.keys, layer.values) for layer in past_key_values.layers]
+    if hasattr(past_key_values, "key_cache"):
+        return list(zip(past_key_values.key_cache, past_key_values.value_cache))
+    return list(past_key_values)
+
+
+class PrefixKVCache:
+    """
+    Keep the kv caches of the previous inputs, so that an input that shares a prefix with one of them (e.g., several questions about the same book) only prefills the rest.
+    The prefixes are indexed by a chained hash of every block_size tokens, and the longest indexed prefix is then extended to the exact common prefix.
+    A matched entry is taken out and cropped to the common prefix instead of copied, and the new input is stored in its place after the generation,
+    so there is one cache per distinct prefix. The least recently used entries are evicted beyond max_size_gb.
+    """
+    def __init__(self, max_size_gb: float=20, block_size: int=256, min_prefix: int=1024):
+        self.max_size = max_size_gb * 1e9
+        self.block_size = block_size
+        self.min_prefix = min_prefix
+        # entry id -> (token ids, past key values, size in bytes, block hashes), in the order of use
+        self.entries = OrderedDict()
+        # block hash -> ids of the entries that contain this prefix
+        self.index = defaultdict(set)
+        self.next_id = 0
+        self.size = 0
+
+
+    def get_block_hashes(self, token_ids) -> List[int]:
+        # hashes[k] identifies the first (k+1) * block_size tokens
+        ids = token_ids.tolist()
+        hashes, h = [], 0
+        for start in range(0, len(ids) - self.block_size + 1, self.block_size):
+            h = hash((h, tuple(ids[start:start+self.block_size])))
+            hashes.append(h)
+        return hashes
+
+
+    def remove(self, entry_id):
+        _, past_key_values, size, hashes = self.entries.pop(entry_id)
+        for h in hashes:
+            self.index[h].discard(entry_id)
+            if len(self.index[h]) == 0:
+                del self.index[h]
+        self.size -= size
+        return past_key_values
+
+
+    def lookup(self, token_ids):
+        """
+        Find the entry with the longest common prefix with token_ids (1d tensor), and return its past key values cropped to the prefix and the prefix length.
+        The entry is removed from the cache, since the caller extends the past key values in place. Returns (None, 0) on a miss.
+        """
+        entry_id = None
+        for h in self.get_block_hashes(token_ids):
+            if h not in self.index:
+                break
+            entry_id = max(self.index[h])
+        if entry_id is None:
+            return None, 0
+
+        cached_ids = self.entries[entry_id][0]
+        n = min(len(cached_ids), len(token_ids))
+        # the hashes may collide, so the common prefix is always checked token by token
+        mismatch = (cached_ids[:n] != token_ids[:n].cpu()).nonzero()
+        length = mismatch[0].item() if len(mismatch) > 0 else n
+        if length < self.min_prefix:
+            return None, 0
+        past_key_values = self.remove(entry_id)
+        past_key_values.crop(length)
+        return past_key_values, length
+
+
+    def store(self, token_ids, past_key_values):
+        """
+        Store the past key values of token_ids (1d tensor), the cache may be longer (e.g., extended by the generation) and is cropped to token_ids.
+        """
+        if not hasattr(past_key_values, "crop"):
+            log_once("the prefix cache only supports DynamicCache, skipping", key="prefix_cache_type", logger=logger, level="warning")
+            return
+        hashes = self.get_block_hashes(token_ids)
+        if len(token_ids) < self.min_prefix or len(hashes) == 0:
+            return
+        past_key_values.crop(len(token_ids))
+        size = get_cache_size(past_key_values)
+        if size > self.max_size:
+            return
+        while len(self.entries) > 0 and self.size + size > self.max_size:
+            self.remove(next(iter(self.entries)))
+
+        entry_id = self.next_id
+        self.next_id += 1
+        self.entries[entry_id] = (token_ids.cpu(), past_key_values, size, hashes)
+        for h in hashes:
+            self.index[h].add(entry_id)
+        self.size += size
+
+
 class HFModel(LLM):
     def __init__(
         self,
@@ -1088,13 +2185,39 @@ class HFModel(LLM):
         self.stop_token_ids = stop_token_ids
         self.device = self.model.device
         self.disable_prefill = False
+        # the token budget of the batched generation, see generate_iter
+        self.batch_tokens = kwargs.get("batch_tokens", None)
+        # the number of tokens per forward pass of the prefill, None prefills the whole input at once, see prefill
+        self.prefill_chunk_size = kwargs.get("prefill_chunk_size", None)
+        self.max_batch_size = kwargs.get("max_batch_size", 32)
+        # the maximum number of running sequences of the continuous batching, see generate_continuous
+        self.max_running = kwargs.get("max_running", None)
+        # the type of the compiled model is OptimizedModule, so the architecture is read from the config
+        self.model_type = getattr(self.model, "_orig_mod", self.model).config.model_type
+        if self.max_running is not None and self.model_type in ["jamba", "recurrent_gemma"]:
+            logger.warning("the recurrent states of this model cannot be batched across sequences, disabling continuous batching")
+            self.max_running = None
+
+        # reuse the kv cache of the previous inputs that share a prefix, see PrefixKVCache
+        self.prefix_cache = None
+        if kwargs.get("prefix_cache_gb", None) is not None:
+            if self.model_type in ["jamba", "recurrent_gemma"]:
+                logger.warning("the recurrent states of this model cannot be cropped to a prefix, disabling the prefix cache")
+            else:
+                self.prefix_cache = PrefixKVCache(max_size_gb=kwargs["prefix_cache_gb"])
 
         if "gemma" in model_name.lower():
             self.disable_prefill = True
             logger.warning("gemma models cannot prefill with past kvs due to cache implementation, need to change the code manually if you need to prefill")
 
+        # the candidates are scored in one pass over the kv cache of the prompt (see score_candidates), the other models generate instead:
+        # it needs the prefill, an attention that takes a 4D mask (or can be switched to sdpa), and no recurrent states, which would see the candidates one after the other
+        base = getattr(self.model, "_orig_mod", self.model)
+        self.supports_scoring = hasattr(base, "model") and not self.disable_prefill and base.config.model_type not in ["jamba", "recurrent_gemma"] \
+            and (base.config._attn_implementation in ["sdpa", "eager"] or hasattr(base, "set_attn_implementation"))
 
-    def prepare_inputs(self, test_item, data):
+
+    def prepare_inputs(self, test_item, data, encodings=None):
         return tokenize(
             test_item,
             data,
@@ -1103,9 +2226,55 @@ class HFModel(LLM):
             generation_max_length=self.generation_max_length,
             use_chat_template=self.use_chat_template,
             system_message=self.system_message,
+            encodings=encodings,
         )
 
 
+    def prepare_inputs_batch(self, test_items, data, batch_size=32):
+        # the contexts are encoded together in batches, and the encodings of a batch are dropped once it is tokenized
+        inputs = []
+        for start in range(0, len(test_items), batch_size):
+            batch = test_items[start:start+batch_size]
+            encodings = prefetch_encodings(self.tokenizer, [test_item["context"] for test_item in batch if isinstance(test_item.get("context"), str)])
+            inputs += [self.prepare_inputs(test_item, data, encodings=encodings) for test_item in batch]
+        return inputs
+
+
+    def prefill(self, input_ids, attention_mask, past_key_values=None):
+        """
+        Run the model over the inputs without calculating the logits (save memory for large vocab models), and return the past key values.
+        With prefill_chunk_size, the inputs are fed in chunks of that many tokens while the cache grows, so only the activations of one chunk are alive at a time.
+        This lowers the peak memory at long context, at the cost of some speed.
+        If past_key_values is given, it already holds the first tokens of the inputs (see PrefixKVCache) and only the rest is fed.
+        """
+        extra = {}
+        chunk_size = self.prefill_chunk_size
+        if "jamba" in str(type(self.model)).lower():
+            from transformers.models.jamba.modeling_jamba import HybridMambaAttentionDynamicCache
+            cache = HybridMambaAttentionDynamicCache(self.model.config, input_ids.shape[0], self.model.dtype, device=self.model.device)
+            extra = {"past_key_values": cache}
+            # the mamba layers do not continue from the previous state when more than one token is fed, so jamba is always prefilled in one pass
+            if chunk_size is not None:
+                log_once("chunked prefill is not supported for jamba models, prefilling in one pass", key="jamba_chunked_prefill", logger=logger, level="warning")
+            chunk_size = None
+
+        if past_key_values is None and (chunk_size is None or input_ids.size(1) <= chunk_size):
+            return self.model.model(input_ids=input_ids, attention_mask=attention_mask, **extra).past_key_values
+
+        from transformers import DynamicCache
+        if past_key_values is None:
+            past_key_values = DynamicCache()
+        if chunk_size is None:
+            chunk_size = input_ids.size(1)
+        for start in range(past_key_values.get_seq_length(), input_ids.size(1), chunk_size):
+            end = start + chunk_size
+            # the attention mask covers the cached tokens and the current chunk
+            prefill = self.model.model(input_ids=input_ids[..., start:end], attention_mask=attention_mask[..., :end], past_key_values=past_key_values, use_cache=True)
+            past_key_values = prefill.past_key_values
+            del prefill
+        return past_key_values
+
+
     @torch.no_grad()
     def generate(self, inputs=None, prompt=None, **kwargs):
         if inputs is None:
@@ -1118,18 +2287,21 @@ class HFModel(LLM):
 
         inputs = inputs.to(self.model.device)
         input_len = inputs.input_ids.size(1)
+        ttft = None
+        past_key_values = None
+        cached_tokens = 0
+        reset_peak_memory()
         if hasattr(self.model, "model") and not self.disable_prefill:
             from transformers import BatchEncoding
-            # prefill without calculating the logits (save memory for large vocab models)
-            # one could also do prefilling by chunks, which would save more memory but is more complex and slower
-            extra = {}
-            if "jamba" in str(type(self.model)).lower():
-                from transformers.models.jamba.modeling_jamba import HybridMambaAttentionDynamicCache
-                cache = HybridMambaAttentionDynamicCache(self.model.config, inputs.input_ids.shape[0], self.model.dtype, device=self.model.device)
-                extra = {"past_key_values": cache}
-
-            prefill = self.model.model(input_ids=inputs.input_ids[..., :-1], attention_mask=inputs.attention_mask[..., :-1], **extra)
-            past_key_values = prefill.past_key_values
+            prefill_start = time.time()
+            prefill_ids = inputs.input_ids[0, :-1]
+            if self.prefix_cache is not None:
+                past_key_values, cached_tokens = self.prefix_cache.lookup(prefill_ids)
+            past_key_values = self.prefill(inputs.input_ids[..., :-1], inputs.attention_mask[..., :-1], past_key_values)
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            # the first token comes right after the prefill, so this is a close approximation of the time to first token
+            ttft = time.time() - prefill_start
             if past_key_values is None:
                 self.disable_prefill = True
                 logger.warning("past key values is None, not able to prefill with KVs, disabling...")
@@ -1155,19 +2327,236 @@ class HFModel(LLM):
         # free up some gpu memory
         del inputs
         del outputs
+        if self.prefix_cache is not None and past_key_values is not None:
+            # the generation extended the cache in place, store returns it to the prefill length
+            self.prefix_cache.store(prefill_ids, past_key_values)
+        del past_key_values
 
-        return {
+        output = {
             "output": text,
             "input_len": input_len,
             "output_len": output_len,
             "input_text": save_prompt,
+            "ttft": ttft,
+            "peak_memory": get_peak_memory(),
         }
+        if self.prefix_cache is not None:
+            output["cached_tokens"] = cached_tokens
+        return output
 
-    def generate_batch(self, inputs=None, prompt=None, **kwargs):
-        # there aren't any particular optimizations that I want to do here...
-        # DDP is possible but won't apply to larger models
-        # https://huggingface.co/docs/transformers/en/llm_optims?static-kv=advanced+usage:+end-to-end+generate+compilation#static-kv-cache-and-torchcompile
-        return super().generate_batch(inputs=inputs, prompt=prompt, **kwargs)
+    @torch.no_grad()
+    def score_candidates(self, inputs, continuations):
+        """
+        The prompt is prefilled once, and all the candidates are scored in one forward pass over its kv cache:
+        the last prompt token and the tokens of every candidate are packed in one sequence, with a tree attention mask where each candidate sees the prompt and its own tokens.
+        This gives the log-probs of all the candidate tokens and of the end after each candidate, which is any of the stop tokens (eos, and the new lines with stop_newline).
+        The packed pass takes a 4D mask, so flash attention is swapped for sdpa during it.
+        """
+        inputs = inputs.to(self.model.device)
+        input_ids = inputs.input_ids
+        continuation_ids = [get_continuation_ids(self.tokenizer, input_ids[0], c) for c in continuations]
+        model = getattr(self.model, "_orig_mod", self.model)
+        past_key_values = self.prefill(input_ids[..., :-1], inputs.attention_mask[..., :-1])
+        prompt_len = input_ids.size(1) - 1
+
+        # the packed sequence is the last prompt token, followed by the tokens of each candidate
+        starts = [1 + sum([len(ids) for ids in continuation_ids[:i]]) for i in range(len(continuation_ids))]
+        packed_len = 1 + sum([len(ids) for ids in continuation_ids])
+        packed_ids = torch.tensor([[input_ids[0, -1].item()] + [t for ids in continuation_ids for t in ids]], dtype=torch.long, device=self.model.device)
+        position_ids = torch.tensor([[prompt_len] + [prompt_len + 1 + k for ids in continuation_ids for k in range(len(ids))]], device=self.model.device)
+        visible = torch.zeros(packed_len, prompt_len + packed_len, dtype=torch.bool, device=self.model.device)
+        visible[:, :prompt_len + 1] = True
+        for start, ids in zip(starts, continuation_ids):
+            visible[start:start+len(ids), prompt_len+start:prompt_len+start+len(ids)] = torch.ones(len(ids), len(ids), dtype=torch.bool, device=self.model.device).tril()
+        mask = torch.zeros(visible.shape, dtype=model.dtype, device=self.model.device).masked_fill(~visible, torch.finfo(model.dtype).min)[None, None]
+
+        attn_implementation = model.config._attn_implementation
+        if attn_implementation not in ["sdpa", "eager"]:
+            model.set_attn_implementation("sdpa")
+        try:
+            hidden = model.model(input_ids=packed_ids, attention_mask=mask, position_ids=position_ids, past_key_values=past_key_values, use_cache=True).last_hidden_state
+        finally:
+            if attn_implementation not in ["sdpa", "eager"]:
+                model.set_attn_implementation(attn_implementation)
+        logprobs = torch.log_softmax(model.get_output_embeddings()(hidden[0]).float(), dim=-1).cpu()
+        del past_key_values, hidden
+
+        scores = [get_candidate_score(torch.cat([logprobs[:1], logprobs[start:start+len(ids)]]), ids, self.stop_token_ids) for start, ids in zip(starts, continuation_ids)]
+        best = max(range(len(scores)), key=lambda i: scores[i])
+
+        save_prompt = self.tokenizer.decode(input_ids[0][:500]) + " <skip> " + self.tokenizer.decode(input_ids[0][-500:])
+        return {
+            "output": continuations[best],
+            "input_len": input_ids.size(1),
+            "output_len": len(continuation_ids[best]),
+            "input_text": save_prompt,
+            "candidate_logprobs": scores,
+        }
+
+
+    @torch.no_grad()
+    def generate_padded(self, inputs_list):
+        """
+        Generate the outputs of a list of tokenized inputs with one call of model.generate, the inputs are left-padded to the longest one.
+        The lengths and the outputs are still counted per sample: the output ends at the first stop token, and the padding after it is dropped.
+        """
+        input_lens = [inputs.input_ids.size(1) for inputs in inputs_list]
+        max_len = max(input_lens)
+        input_ids = torch.full((len(inputs_list), max_len), self.tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros_like(input_ids)
+        for i, inputs in enumerate(inputs_list):
+            input_ids[i, max_len-input_lens[i]:] = inputs.input_ids[0]
+            attention_mask[i, max_len-input_lens[i]:] = 1
+
+        outputs = self.model.generate(
+            input_ids=input_ids.to(self.model.device),
+            attention_mask=attention_mask.to(self.model.device),
+            max_new_tokens=self.generation_max_length,
+            min_new_tokens=self.generation_min_length,
+            do_sample=self.do_sample,
+            temperature=self.temperature,
+            top_p=self.top_p,
+            eos_token_id=self.stop_token_ids,
+            pad_token_id=self.tokenizer.pad_token_id,
+            return_dict_in_generate=True,
+            output_scores=False,
+        )
+        sequences = outputs["sequences"][:, max_len:].cpu()
+        del outputs
+
+        results = []
+        stops = torch.isin(sequences, torch.tensor(self.stop_token_ids, dtype=sequences.dtype))
+        for i, inputs in enumerate(inputs_list):
+            # the stop token is counted as in generate, where the sequence ends right after it
+            stop_positions = stops[i].nonzero()
+            output_len = stop_positions[0].item() + 1 if len(stop_positions) > 0 else sequences.size(1)
+            results.append({
+                "output": self.tokenizer.decode(sequences[i, :output_len], skip_special_tokens=True),
+                "input_len": input_lens[i],
+                "output_len": output_len,
+                "input_text": self.tokenizer.decode(inputs["input_ids"][0][:500]) + " <skip> " + self.tokenizer.decode(inputs["input_ids"][0][-500:]),
+                "ttft": None,
+            })
+        return results
+
+
+    def generate_iter(self, inputs=None, prompt=None, **kwargs):
+        """
+        With batch_tokens, the inputs are grouped into length buckets (see get_length_buckets) and each bucket is generated with one call of model.generate.
+        The buckets of one sample go through generate, which keeps the memory-saving prefill for the long inputs.
+        """
+        if inputs is not None and self.max_running is not None:
+            yield from self.generate_continuous(inputs)
+            return
+        if inputs is None or self.batch_tokens is None:
+            yield from super().generate_iter(inputs=inputs, prompt=prompt, **kwargs)
+            return
+
+        submit_time = time.time()
+        lengths = [x.input_ids.size(1) + self.generation_max_length for x in inputs]
+        with tqdm(total=len(inputs)) as pbar:
+            for batch in get_length_buckets(lengths, self.batch_tokens, self.max_batch_size):
+                start_time = time.time()
+                if len(batch) == 1:
+                    outputs = [self.generate(inputs=inputs[batch[0]], **kwargs)]
+                else:
+                    outputs = self.generate_padded([inputs[idx] for idx in batch])
+                end_time = time.time()
+                for idx, output in zip(batch, outputs):
+                    yield idx, add_telemetry(output, submit_time, start_time, end_time)
+                pbar.update(len(batch))
+
+
+    def sample_next_token(self, logits, num_generated):
+        """
+        Sample the next token of each row from the last logits, the stop tokens are masked until the row has generated generation_min_length tokens.
+        """
+        logits = logits.float()
+        too_short = torch.tensor([n < self.generation_min_length for n in num_generated], device=logits.device)
+        if too_short.any():
+            logits[too_short.nonzero()[:, 0].unsqueeze(1), torch.tensor(self.stop_token_ids, device=logits.device)] = -float("inf")
+        if not self.do_sample:
+            return logits.argmax(dim=-1)
+        probs = torch.softmax(logits / self.temperature, dim=-1)
+        sorted_probs, sorted_ids = probs.sort(dim=-1, descending=True)
+        # keep the smallest set of tokens whose cumulative probability reaches top_p
+        sorted_probs[(sorted_probs.cumsum(dim=-1) - sorted_probs) > self.top_p] = 0
+        return sorted_ids.gather(-1, torch.multinomial(sorted_probs, 1)).squeeze(-1)
+
+
+    def finish_sequence(self, sequence, submit_time):
+        input_ids = sequence["input_ids"]
+        output = {
+            "output": self.tokenizer.decode(sequence["tokens"], skip_special_tokens=True),
+            "input_len": len(input_ids),
+            "output_len": len(sequence["tokens"]),
+            "input_text": self.tokenizer.decode(input_ids[:500]) + " <skip> " + self.tokenizer.decode(input_ids[-500:]),
+            "ttft": sequence["ttft"],
+        }
+        return add_telemetry(output, submit_time, sequence["start_time"], time.time())
+
+
+    @torch.no_grad()
+    def generate_continuous(self, inputs):
+        """
+        Continuous batching: up to max_running sequences are decoded together with one forward pass per step, and a new input is admitted as soon as a running sequence stops,
+        so the short outputs (e.g., stopping at the first new line) do not leave the batch half empty like static batches.
+        The sequences are the slots of one preallocated cache (see SlotKVCache). An admitted input is prefilled one chunk of prefill_chunk_size tokens (2048 by default) per decode step,
+        so the running sequences keep decoding, and its last prompt token is fed with the next step, which samples its first token.
+        The model runs uncompiled here, as the shapes of the prefill chunks vary.
+        Yields (index, output) as soon as each sequence finishes.
+        """
+        from transformers import DynamicCache
+        model = getattr(self.model, "_orig_mod", self.model)
+        prefill_model = model.model if hasattr(model, "model") and not self.disable_prefill else model
+        chunk_size = self.prefill_chunk_size or 2048
+        cache = SlotKVCache(model, self.max_running, max([x.input_ids.size(1) for x in inputs]), self.generation_max_length, slack=max(self.generation_max_length, 256))
+        if not cache.is_supported():
+            log_once("continuous batching needs a static kv cache without sliding window layers, generating one at a time", key="continuous_batching", logger=logger, level="warning")
+            yield from super().generate_iter(inputs=inputs)
+            return
+
+        submit_time = time.time()
+        waiting = list(reversed(self.get_submission_order(inputs)))
+        slots = [None for _ in range(self.max_running)]
+        admitting = None
+        with tqdm(total=len(inputs)) as pbar:
+            while len(waiting) > 0 or admitting is not None or any([s is not None for s in slots]):
+                if admitting is None and len(waiting) > 0 and None in slots:
+                    idx = waiting.pop()
+                    admitting = {"idx": idx, "input_ids": inputs[idx].input_ids[0].cpu(), "tokens": [], "start_time": time.time(), "ttft": None, "past_key_values": DynamicCache(), "prefilled": 0}
+                if admitting is not None:
+                    # all but the last prompt token, one chunk per step unless nothing else is running
+                    prompt_ids = admitting["input_ids"][:-1].unsqueeze(0).to(self.model.device)
+                    while admitting["prefilled"] < prompt_ids.size(1):
+                        end = admitting["prefilled"] + chunk_size
+                        prefill_model(input_ids=prompt_ids[:, admitting["prefilled"]:end], past_key_values=admitting["past_key_values"], use_cache=True)
+                        admitting["prefilled"] = min(end, prompt_ids.size(1))
+                        if any([s is not None for s in slots]):
+                            break
+                    if admitting["prefilled"] == prompt_ids.size(1):
+                        slot = slots.index(None)
+                        cache.admit(slot, admitting.pop("past_key_values"), prompt_ids.size(1))
+                        slots[slot] = admitting
+                        admitting = None
+
+                active = [i for i, s in enumerate(slots) if s is not None]
+                if len(active) == 0:
+                    continue
+                input_ids = torch.tensor([[(s["tokens"][-1] if len(s["tokens"]) > 0 else s["input_ids"][-1].item()) if s is not None else self.tokenizer.pad_token_id] for s in slots], device=self.model.device)
+                logits = cache.step(model, input_ids)
+                tokens = self.sample_next_token(logits[active], [len(slots[i]["tokens"]) for i in active])
+                for i, token in zip(active, tokens.tolist()):
+                    sequence = slots[i]
+                    if len(sequence["tokens"]) == 0:
+                        sequence["ttft"] = time.time() - sequence["start_time"]
+                    sequence["tokens"].append(token)
+                    # the sequences stop after a stop token (including the new lines with stop_newline) or generation_max_length tokens
+                    if token in self.stop_token_ids or len(sequence["tokens"]) >= self.generation_max_length:
+                        yield sequence["idx"], self.finish_sequence(sequence, submit_time)
+                        pbar.update(1)
+                        slots[i] = None
+                        cache.release(i)
 
 
 class VLLMModel(LLM):
@@ -1218,7 +2607,7 @@ class VLLMModel(LLM):
             self.tokenizer.pad_token_id = self.tokenizer.eos_token_id
 
 
-    def prepare_inputs(self, test_item, data):
+    def prepare_inputs(self, test_item, data, encodings=None):
         return tokenize(
             test_item,
             data,
@@ -1227,9 +2616,20 @@ class VLLMModel(LLM):
             generation_max_length=self.generation_max_length,
             use_chat_template=self.use_chat_template,
             system_message=self.system_message,
+            encodings=encodings,
         )
 
 
+    def prepare_inputs_batch(self, test_items, data, batch_size=32):
+        # the contexts are encoded together in batches, and the encodings of a batch are dropped once it is tokenized
+        inputs = []
+        for start in range(0, len(test_items), batch_size):
+            batch = test_items[start:start+batch_size]
+            encodings = prefetch_encodings(self.tokenizer, [test_item["context"] for test_item in batch if isinstance(test_item.get("context"), str)])
+            inputs += [self.prepare_inputs(test_item, data, encodings=encodings) for test_item in batch]
+        return inputs
+
+
     def generate(self, inputs=None, prompt: str=None, **kwargs):
         from vllm import SamplingParams, TokensPrompt
         if inputs is None:
@@ -1299,10 +2699,35 @@ class VLLMModel(LLM):
                 "input_len": len(output.prompt_token_ids),
                 "output_len": len(output.outputs[0].token_ids),
                 'input_text': (self.tokenizer.decode(output.prompt_token_ids[:500]) + " <skip> " + self.tokenizer.decode(output.prompt_token_ids[-500:])) if len(output.prompt_token_ids) > 1000 else self.tokenizer.decode(output.prompt_token_ids),
+                **self.get_telemetry(output),
             } for output in outputs
         ]
 
 
+    def get_telemetry(self, output):
+        """
+        Get the per-request telemetry (see add_telemetry) from the vllm request metrics, which are not available in all vllm versions.
+        """
+        metrics = getattr(output, "metrics", None)
+        if metrics is None or getattr(metrics, "first_token_time", None) is None:
+            return {}
+        latency = metrics.finished_time - metrics.first_scheduled_time
+        decode_time = metrics.finished_time - metrics.first_token_time
+        return {
+            "submit_time": metrics.arrival_time,
+            "queue_time": metrics.first_scheduled_time - metrics.arrival_time,
+            "latency": latency,
+            "ttft": metrics.first_token_time - metrics.first_scheduled_time,
+            "decode_tokens_per_sec": len(output.outputs[0].token_ids) / decode_time if decode_time > 0 else None,
+        }
+
+
+    def generate_iter(self, inputs=None, prompt=None, **kwargs):
+        # the offline engine schedules the whole batch at once, so we can only yield after everything is done
+        for idx, output in enumerate(self.generate_batch(inputs=inputs, prompt=prompt, **kwargs)):
+            yield idx, output
+
+
 class SGLangModel(LLM):
     def __init__(
         self,
@@ -1416,6 +2841,12 @@ class SGLangModel(LLM):
         ]
 
 
+    def generate_iter(self, inputs=None, prompt=None, **kwargs):
+        # the offline engine schedules the whole batch at once, so we can only yield after everything is done
+        for idx, output in enumerate(self.generate_batch(inputs=inputs, prompt=prompt, **kwargs)):
+            yield idx, output
+
+
 def load_LLM(args):
     kwargs = {}
     if args.use_tgi_serving or args.use_vllm_serving:
@@ -1423,6 +2854,7 @@ def load_LLM(args):
         kwargs['seed'] = args.seed
         kwargs["endpoint_url"] = args.endpoint_url
         kwargs["api_key"] = args.api_key
+        kwargs["balance_by"] = args.balance_by
     elif "gpt" in args.model_name_or_path:
         model_cls = OpenAIModel
         kwargs['seed'] = args.seed
@@ -1447,6 +2879,15 @@ def load_LLM(args):
             kwargs["torch_dtype"] = torch.float32
         if args.rope_theta is not None:
             kwargs["rope_theta"] = args.rope_theta
+        if getattr(args, "prefill_chunk_size", None) is not None:
+            kwargs["prefill_chunk_size"] = args.prefill_chunk_size
+        if getattr(args, "prefix_cache_gb", None) is not None:
+            kwargs["prefix_cache_gb"] = args.prefix_cache_gb
+        if getattr(args, "continuous_batching", None) is not None:
+            kwargs["max_running"] = args.continuous_batching
+        if getattr(args, "batch_tokens", None) is not None:
+            kwargs["batch_tokens"] = args.batch_tokens
+            kwargs["max_batch_size"] = args.max_batch_size
 
     logger.info(f"Loading model {args.model_name_or_path} with {model_cls.__name__}")
     model = model_cls(
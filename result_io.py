@@ -0,0 +1,135 @@
+"""
+Writing and reading the output json files of eval.py.
+The samples are written one per line without indentation, and the large fields (e.g., input_text, which is the whole context for the API models)
+are moved to a gzip-compressed blob file next to the output, keyed by the hash of their content, so that the same content is only stored once.
+The output file itself is still valid json, and load_results puts the large fields back, so the readers get the same structure as before.
+"""
+
+import os
+import json
+import gzip
+import hashlib
+
+BLOB_FIELDS = ["input_text", "context"]
+MIN_BLOB_SIZE = 4096
+BLOB_KEY = "__blob__"
+
+
+def get_blob_path(path):
+    return path + ".blobs.gz"
+
+
+def is_blob_ref(value):
+    return isinstance(value, dict) and len(value) == 1 and BLOB_KEY in value
+
+
+def get_content_hash(value):
+    return hashlib.sha256(json.dumps(value, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class ResultWriter:
+    """
+    Write the samples one at a time, and the rest of the output (args, metrics, ...) when closing.
+    Everything is written to temporary files first, so a crash never leaves a truncated output behind.
+    """
+    def __init__(self, path, blob_fields=BLOB_FIELDS, min_blob_size=MIN_BLOB_SIZE):
+        self.path = path
+        self.blob_fields = blob_fields
+        self.min_blob_size = min_blob_size
+        self.seen_blobs = set()
+        self.num_samples = 0
+
+        self.f = open(path + ".tmp", "w")
+        self.blob_f = gzip.open(get_blob_path(path) + ".tmp", "wt", encoding="utf-8", compresslevel=6)
+        self.f.write('{"data": [\n')
+
+
+    def write_blob(self, value):
+        h = get_content_hash(value)
+        if h not in self.seen_blobs:
+            self.seen_blobs.add(h)
+            self.blob_f.write(json.dumps({"hash": h, "value": value}, ensure_ascii=False) + "\n")
+        return {BLOB_KEY: h}
+
+
+    def compact(self, sample):
+        """
+        Write the large fields of the sample to the blob file now, and return the sample with references in their place.
+        This lets the caller keep the (small) samples around, e.g., to write them in order at the end, without keeping the large fields in memory.
+        """
+        sample = dict(sample)
+        for field in self.blob_fields:
+            if field not in sample or is_blob_ref(sample[field]):
+                continue
+            if len(json.dumps(sample[field], ensure_ascii=False)) >= self.min_blob_size:
+                sample[field] = self.write_blob(sample[field])
+        return sample
+
+
+    def write(self, sample):
+        sample = self.compact(sample)
+        if self.num_samples > 0:
+            self.f.write(",\n")
+        self.f.write(json.dumps(sample, ensure_ascii=False))
+        self.num_samples += 1
+
+
+    def close(self, **fields):
+        self.f.write("\n]")
+        for k, v in fields.items():
+            self.f.write(f",\n{json.dumps(k)}: {json.dumps(v, ensure_ascii=False)}")
+        self.f.write("}\n")
+        self.f.close()
+        self.blob_f.close()
+        os.replace(self.path + ".tmp", self.path)
+        if len(self.seen_blobs) > 0:
+            os.replace(get_blob_path(self.path) + ".tmp", get_blob_path(self.path))
+        else:
+            os.remove(get_blob_path(self.path) + ".tmp")
+            if os.path.exists(get_blob_path(self.path)):
+                os.remove(get_blob_path(self.path))
+
+
+    def abort(self):
+        self.f.close()
+        self.blob_f.close()
+        os.remove(self.path + ".tmp")
+        os.remove(get_blob_path(self.path) + ".tmp")
+
+
+def write_results(output, path, **kwargs):
+    """
+    Write the output dictionary (with the samples under "data") to path, see ResultWriter.
+    """
+    writer = ResultWriter(path, **kwargs)
+    for sample in output.get("data", []):
+        writer.write(sample)
+    writer.close(**{k: v for k, v in output.items() if k != "data"})
+
+
+def load_blobs(path):
+    blobs = {}
+    if os.path.exists(get_blob_path(path)):
+        with gzip.open(get_blob_path(path), "rt", encoding="utf-8") as f:
+            for line in f:
+                d = json.loads(line)
+                blobs[d["hash"]] = d["value"]
+    return blobs
+
+
+def load_results(path, resolve_blobs=True):
+    """
+    Load an output file written by write_results (or the older, fully inlined json files).
+    If resolve_blobs is False, the large fields are left as references, which is faster when only the metrics are needed.
+    """
+    with open(path) as f:
+        results = json.load(f)
+    if not resolve_blobs or not isinstance(results, dict) or not os.path.exists(get_blob_path(path)):
+        return results
+
+    blobs = load_blobs(path)
+    for sample in results.get("data", []):
+        for k, v in sample.items():
+            if is_blob_ref(v):
+                sample[k] = blobs[v[BLOB_KEY]]
+    return results
@@ -1,11 +1,14 @@
 import os
-import json
 import numpy as np
 import pandas as pd
 import yaml
 from dataclasses import dataclass, asdict
 from tqdm import tqdm
 import argparse
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from result_io import load_results
 
 dataset_to_metrics = {
     "json_kv": "substring_exact_match",
@@ -117,8 +120,7 @@ class arguments:
         if not os.path.exists(path):
             print("path doesn't exist")
             return None
-        with open(path) as f:
-            results = json.load(f)
+        results = load_results(path, resolve_blobs=False)
         
         _, metric = self.get_metric_name()
         if path.endswith(".score"):
@@ -142,8 +144,7 @@ class arguments:
         print(path)
         if not os.path.exists(path):
             return None
-        with open(path) as f:
-            results = json.load(f)
+        results = load_results(path, resolve_blobs=False)
 
         output = []        
         _, metric = self.get_metric_name()
@@ -12,6 +12,7 @@ parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.append(parent_dir)
 
 from model_utils import OpenAIModel
+from result_io import load_results, write_results
 
 def parse_output(output, prefix="Answer:"):
     output = output.replace("\n", " ")
@@ -61,8 +62,7 @@ def parse_json(text):
     return None
 
 def check_metrics(model, results_file, output_file):
-    with open(results_file, "r") as f:
-        results = json.load(f)
+    results = load_results(results_file)
 
     sum_score = 0
     count_score = 0
@@ -98,8 +98,7 @@ def check_metrics(model, results_file, output_file):
             print(f"Final score: {s}")
 
     results["averaged_metrics"]["gpt-4-score"] = sum_score / count_score
-    with open(output_file, "w") as f:
-        json.dump(results, f, indent=4)
+    write_results(results, output_file)
 
     return results
 
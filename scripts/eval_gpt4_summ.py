@@ -13,6 +13,7 @@ parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.append(parent_dir)
 
 from model_utils import OpenAIModel
+from result_io import load_results, write_results
 
 # prompts inspired by https://www.databricks.com/blog/LLM-auto-eval-best-practices-RAG
 fluency_prompt="""Please act as an impartial judge and evaluate the fluency of the provided text. The text should be coherent, non-repetitive, fluent, and grammatically correct.
@@ -342,8 +343,7 @@ def parse_json(text):
     return None
 
 def check_metrics(model, results_file, output_file):
-    with open(results_file, "r") as f:
-        results = json.load(f)
+    results = load_results(results_file)
 
     keypoints = {}
     if "infbench" in results_file:
@@ -421,8 +421,7 @@ def check_metrics(model, results_file, output_file):
     }
     results["averaged_metrics"].update(averaged)
 
-    with open(output_file, "w") as f:
-        json.dump(results, f, indent=4)
+    write_results(results, output_file)
     print(f"Saved to {output_file}")
 
     return results
@@ -0,0 +1,252 @@
+"""
+Plan an evaluation before launching it: count the input tokens of every (dataset, length) in the configs and predict the wall time, the number of concurrent slots, and the API cost.
+The token counts only need a tokenizer (HF, tiktoken, the Claude tokenizer, or the Gemini local tokenizer), and they are cached on disk so re-planning is fast.
+
+Example:
+    python scripts/plan_eval.py --configs configs/recall.yaml configs/rag.yaml --model_name_or_path meta-llama/Llama-3.1-8B-Instruct --profile profile.yaml --target_hours 12
+where profile.yaml declares the per-request throughput and the prices (the same keys as the command line arguments below), e.g.,
+    prefill_tokens_per_sec: 8000
+    decode_tokens_per_sec: 40
+    slots: 16
+Alternatively, use --measured to take the throughput from the telemetry of a previous run's output file.
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import os
+import sys
+
+import numpy as np
+import yaml
+from tqdm import tqdm
+
+# Get the parent directory path
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+# Add the parent directory to the Python path
+sys.path.append(parent_dir)
+
+from data import load_data
+from model_utils import format_chat
+from result_io import load_results
+
+CACHE_DIR = os.getenv("HELMET_CACHE_DIR", os.path.expanduser("~/.cache/helmet"))
+
+
+class TokenCounter:
+    """
+    Count the tokens of the prompts with the tokenizer that the model would use, the counts are cached by (tokenizer, prompt hash).
+    """
+    def __init__(self, model_name, tokenizer_name=None, use_chat_template=False, system_message=None, use_completions_api=True):
+        self.use_chat_template = use_chat_template
+        self.system_message = system_message
+        # eval.py always uses the completions API for the OpenAI models (the OpenAIModel default)
+        self.use_completions_api = use_completions_api
+        # the prompt follows the model class (see load_LLM), even when another tokenizer counts it
+        self.api = "openai" if "gpt" in model_name else "anthropic" if "claude" in model_name else "gemini" if "gemini" in model_name else None
+        name = tokenizer_name if tokenizer_name is not None else model_name
+        if "gpt" in name:
+            import tiktoken
+            self.kind, self.name = "tiktoken", name
+            self.tokenizer = tiktoken.encoding_for_model(name)
+        elif "claude" in name:
+            from tokenizers import Tokenizer
+            self.kind, self.name = "claude", "claude"
+            self.tokenizer = Tokenizer.from_file(os.path.join(parent_dir, "claude.tokenizer.json"))
+        elif "gemini" in name:
+            from vertexai.preview.tokenization import get_tokenizer_for_model
+            self.kind, self.name = "gemini", name
+            self.tokenizer = get_tokenizer_for_model(name)
+        else:
+            from transformers import AutoTokenizer
+            self.kind, self.name = "hf", name
+            self.tokenizer = AutoTokenizer.from_pretrained(name, trust_remote_code=True)
+
+        self.cache_path = os.path.join(CACHE_DIR, "token_counts", f"{self.name.replace('/', '__')}_chat{use_chat_template}.jsonl")
+        self.cache = {}
+        if os.path.exists(self.cache_path):
+            with open(self.cache_path) as f:
+                for line in f:
+                    d = json.loads(line)
+                    self.cache[d["hash"]] = d["count"]
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        self.cache_f = open(self.cache_path, "a")
+
+
+    def count(self, test_item, data):
+        if self.api == "openai":
+            # the same format as OpenAIModel.prepare_inputs, which only sends the user_template without the completions API
+            template = data["prompt_template"] if self.use_completions_api else data["user_template"]
+            prompt = format_chat(template.format(**test_item), system_message=self.system_message)
+            text = "\n".join([f"Role: {x['role']}\nContent: {x['content']}" for x in prompt])
+        elif self.api == "anthropic":
+            # the same format as AnthropicModel.prepare_inputs, the system message is passed separately
+            prompt = format_chat(data["user_template"].format(**test_item), system_message=None)
+            text = "\n".join([f"Role: {x['role']}\nContent: {x['content']}" for x in prompt])
+        elif self.api == "gemini":
+            # GeminiModel sends the prompt as is
+            text = data["prompt_template"].format(**test_item)
+        elif self.kind == "hf" and self.use_chat_template:
+            text = json.dumps(format_chat(data["user_template"].format(**test_item), system_message=self.system_message), ensure_ascii=False)
+        else:
+            text = data["prompt_template"].format(**test_item)
+
+        h = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        if h not in self.cache:
+            self.cache[h] = self.count_text(text)
+            self.cache_f.write(json.dumps({"hash": h, "count": self.cache[h]}) + "\n")
+        return self.cache[h]
+
+
+    def count_text(self, text):
+        if self.kind == "hf" and self.use_chat_template and self.api is None:
+            chat = json.loads(text)
+            try:
+                return len(self.tokenizer.apply_chat_template(chat, tokenize=True, add_generation_prompt=True))
+            except Exception:
+                # sometimes the tokenizer doesn't support system message
+                return len(self.tokenizer.apply_chat_template(chat[-1:], tokenize=True, add_generation_prompt=True))
+        elif self.kind == "hf":
+            return len(self.tokenizer(text)["input_ids"])
+        elif self.kind == "tiktoken":
+            return len(self.tokenizer.encode(text))
+        elif self.kind == "claude":
+            return len(self.tokenizer.encode(text).ids)
+        return self.tokenizer.count_tokens(text).total_tokens
+
+
+def get_evals(config):
+    """
+    Expand a config into (dataset, test_file, demo_file, max_length, gen_length), the same way as eval.py.
+    """
+    datasets = config["datasets"].split(",")
+    test_files = config["test_files"].split(",")
+    demo_files = config["demo_files"].split(",")
+    max_lengths = [int(l) for l in str(config.get("input_max_length", 8192)).split(",")]
+    gen_lengths = [int(l) for l in str(config.get("generation_max_length", 10)).split(",")]
+    max_lengths = max_lengths * len(datasets) if len(max_lengths) == 1 else max_lengths
+    gen_lengths = gen_lengths * len(datasets) if len(gen_lengths) == 1 else gen_lengths
+    return list(zip(datasets, test_files, demo_files, max_lengths, gen_lengths))
+
+
+def get_measured_profile(paths):
+    """
+    Get the per-request prefill and decode throughput from the telemetry of previous runs (see eval.summarize_telemetry).
+    The prefill rate is the input tokens over the time to first token, and the decode rate is the output tokens over the rest of the request.
+    """
+    input_tokens, prefill_time, output_tokens, decode_time = 0, 0, 0, 0
+    for path in paths:
+        for d in load_results(path, resolve_blobs=False)["data"]:
+            if d.get("ttft") is None or d.get("latency") is None:
+                continue
+            input_tokens += d["input_len"]
+            prefill_time += d["ttft"]
+            output_tokens += d["output_len"]
+            decode_time += d["latency"] - d["ttft"]
+    if prefill_time == 0 or decode_time == 0:
+        raise ValueError("No time to first token found in the measured runs, use --stream for the API models or declare the profile instead")
+    return {"prefill_tokens_per_sec": input_tokens / prefill_time, "decode_tokens_per_sec": output_tokens / decode_time}
+
+
+def get_histogram(lengths, max_length):
+    # power-of-two buckets from 1k up to max_length, and one for the inputs longer than max_length
+    edges = [2**i for i in range(10, int(math.log2(max(max_length, 1))) + 1)]
+    if len(edges) == 0 or edges[-1] < max_length:
+        edges.append(max_length)
+    counts, _ = np.histogram(lengths, bins=[0] + edges + [float("inf")])
+    labels = [f"<{e/1024:g}k" for e in edges] + [f">={edges[-1]/1024:g}k"]
+    return " ".join([f"{l}:{c}" for l, c in zip(labels, counts) if c > 0])
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="plan the token budget, wall time and cost of the evaluation configs")
+    parser.add_argument("--configs", type=str, nargs="+", required=True, help="the eval config files")
+    parser.add_argument("--profile", type=str, default=None, help="yaml file that declares the throughput and price arguments below")
+    parser.add_argument("--measured", type=str, nargs="+", default=None, help="output files of previous runs (with telemetry) to measure the prefill/decode throughput from")
+    parser.add_argument("--model_name_or_path", type=str, default=None, help="the model to plan for, defaults to the one in the config")
+    parser.add_argument("--tokenizer_name", type=str, default=None, help="override the tokenizer used to count the tokens, e.g., a similar open model for an API model")
+    parser.add_argument("--max_test_samples", type=int, default=None, help="override the number of samples in the configs")
+
+    parser.add_argument("--prefill_tokens_per_sec", type=float, default=None, help="prefill throughput of one request")
+    parser.add_argument("--decode_tokens_per_sec", type=float, default=None, help="decode throughput of one request")
+    parser.add_argument("--slots", type=int, default=1, help="number of concurrent requests (e.g., MAX_WORKERS or max_concurrency)")
+    parser.add_argument("--output_fraction", type=float, default=1.0, help="expected fraction of generation_max_length that is generated, 1.0 is the upper bound")
+    parser.add_argument("--input_price", type=float, default=0.0, help="price per million input tokens")
+    parser.add_argument("--output_price", type=float, default=0.0, help="price per million output tokens")
+    parser.add_argument("--target_hours", type=float, default=None, help="report the number of slots needed to finish within this time")
+
+    args = parser.parse_args()
+    profile = yaml.safe_load(open(args.profile)) if args.profile is not None else {}
+    parser.set_defaults(**profile)
+    args = parser.parse_args()
+    if args.measured is not None:
+        for k, v in get_measured_profile(args.measured).items():
+            setattr(args, k, v)
+    return args
+
+
+def main():
+    args = parse_arguments()
+    counters = {}
+    rows = []
+    for config_file in args.configs:
+        config = yaml.safe_load(open(config_file))
+        model_name = args.model_name_or_path or config.get("model_name_or_path")
+        use_chat_template = config.get("use_chat_template", False)
+        key = (model_name, use_chat_template)
+        if key not in counters:
+            counters[key] = TokenCounter(model_name, args.tokenizer_name, use_chat_template=use_chat_template, system_message=config.get("system_message"))
+        counter = counters[key]
+
+        data_args = argparse.Namespace(
+            shots=config.get("shots", 2),
+            max_test_samples=args.max_test_samples if args.max_test_samples is not None else config.get("max_test_samples"),
+            seed=config.get("seed", 42),
+        )
+        for dataset, test_file, demo_file, max_length, gen_length in get_evals(config):
+            data = load_data(data_args, dataset, test_file, demo_file)
+            lengths = [counter.count(dict(item), data) for item in tqdm(data["data"], desc=f"Counting {dataset} {max_length}")]
+            # the contexts are truncated to fit the generation into max_length
+            inputs = np.minimum(np.array(lengths), max_length - gen_length)
+            outputs = np.full(len(inputs), gen_length * args.output_fraction)
+            rows.append({
+                "config": os.path.basename(config_file),
+                "dataset": dataset,
+                "max_length": max_length,
+                "samples": len(inputs),
+                "truncated": int((np.array(lengths) > max_length - gen_length).sum()),
+                "mean_input": float(inputs.mean()) if len(inputs) > 0 else 0.0,
+                "input_tokens": int(inputs.sum()),
+                "output_tokens": int(outputs.sum()),
+                "histogram": get_histogram(lengths, max_length),
+                "inputs": inputs,
+                "outputs": outputs,
+            })
+
+    has_profile = args.prefill_tokens_per_sec is not None and args.decode_tokens_per_sec is not None
+    total_latency, total_input, total_output, longest = 0.0, 0, 0, 0.0
+    for row in rows:
+        total_input += row["input_tokens"]
+        total_output += row["output_tokens"]
+        msg = f"{row['config']} {row['dataset']} in{row['max_length']}: {row['samples']} samples, {row['truncated']} truncated, mean input {row['mean_input']:.0f}, total input {row['input_tokens']}, max output {row['output_tokens']}, histogram {row['histogram']}"
+        if has_profile:
+            latency = row["inputs"] / args.prefill_tokens_per_sec + row["outputs"] / args.decode_tokens_per_sec
+            total_latency += latency.sum()
+            longest = max(longest, latency.max(initial=0))
+            msg += f", wall time {max(latency.sum() / args.slots, latency.max(initial=0)) / 3600:.02f} h"
+        print(msg)
+
+    cost = total_input / 1e6 * args.input_price + total_output / 1e6 * args.output_price
+    print(f"Total: {sum([r['samples'] for r in rows])} samples, {total_input} input tokens, {total_output} output tokens, cost {cost:.02f}")
+    if has_profile:
+        # the requests are spread over the slots, but the longest request is a lower bound on the wall time
+        print(f"Predicted wall time with {args.slots} slots: {max(total_latency / args.slots, longest) / 3600:.02f} h (prefill {args.prefill_tokens_per_sec:.0f} tok/s, decode {args.decode_tokens_per_sec:.02f} tok/s per request)")
+        if args.target_hours is not None:
+            print(f"Slots needed to finish within {args.target_hours} h: {math.ceil(total_latency / (args.target_hours * 3600))}")
+    else:
+        print("Declare --prefill_tokens_per_sec and --decode_tokens_per_sec (or use --profile/--measured) to predict the wall time")
+
+
+if __name__ == "__main__":
+    main()
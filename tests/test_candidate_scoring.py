@@ -0,0 +1,118 @@
+import math
+import os
+import string
+
+import pytest
+
+pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from model_utils import get_candidate_score, get_continuation_ids
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class DigitTokenizer:
+    # a fake tokenizer with one token per character, so the digits are split like in the llama and mistral tokenizers
+    def __call__(self, text, add_special_tokens=False):
+        return {"input_ids": [ord(c) for c in text]}
+
+    def decode(self, ids, skip_special_tokens=False):
+        return "".join([chr(i) for i in ids])
+
+
+def next_logprobs(path):
+    # a fake model that prefers the label "12", but puts most of the probability of the first digit on "1"
+    probs = {
+        "": {" ": 1.0},
+        " ": {"1": 0.9, "3": 0.1},
+        " 1": {"2": 0.8, "\n": 0.2},
+        " 12": {"\n": 0.95, "3": 0.05},
+    }.get("".join([chr(i) for i in path]), {"\n": 1.0})
+    logprobs = torch.full((128,), -math.inf)
+    for c, p in probs.items():
+        logprobs[ord(c)] = math.log(p)
+    return logprobs
+
+
+def test_prefix_label_does_not_win():
+    tokenizer = DigitTokenizer()
+    input_ids = torch.tensor(tokenizer("Label:")["input_ids"])
+    candidates = [" 1", " 12"]
+    continuation_ids = [get_continuation_ids(tokenizer, input_ids, c) for c in candidates]
+    assert continuation_ids == [[32, 49], [32, 49, 50]]
+
+    logprobs = [torch.stack([next_logprobs(ids[:k]) for k in range(len(ids) + 1)]) for ids in continuation_ids]
+    # without the end of the output, the label "1" is a prefix of "12", so it always scores higher
+    prefix_scores = [sum([float(lp[k][t]) for k, t in enumerate(ids)]) for lp, ids in zip(logprobs, continuation_ids)]
+    assert prefix_scores[0] > prefix_scores[1]
+    scores = [get_candidate_score(lp, ids, [ord("\n")]) for lp, ids in zip(logprobs, continuation_ids)]
+    assert scores[0] == pytest.approx(math.log(0.9 * 0.2))
+    assert scores[1] == pytest.approx(math.log(0.9 * 0.8 * 0.95))
+    assert scores[1] > scores[0]
+
+
+def test_end_is_any_stop_token():
+    logprobs = torch.log(torch.tensor([[0.5, 0.3, 0.2]]))
+    assert get_candidate_score(logprobs, [], [1, 2]) == pytest.approx(math.log(0.5))
+    assert get_candidate_score(torch.tensor([[0.0, -math.inf]]), [], [1]) == -math.inf
+
+
+def get_real_tokenizers():
+    from tokenizers import Tokenizer, decoders, models, normalizers, pre_tokenizers, trainers
+    from transformers import PreTrainedTokenizerFast
+    byte_level = PreTrainedTokenizerFast(tokenizer_file=os.path.join(ROOT, "claude.tokenizer.json"))
+    # the pipeline of the llama 2 tokenizer: a prefix space is added to the text and the spaces become "▁", and the decoding drops the leading space,
+    # so the tail of the prompt does not tokenize back to the same tokens when it starts in the middle of a word
+    sentencepiece = Tokenizer(models.BPE(unk_token="<unk>"))
+    sentencepiece.normalizer = normalizers.Sequence([normalizers.Prepend("▁"), normalizers.Replace(" ", "▁")])
+    sentencepiece.pre_tokenizer = pre_tokenizers.Metaspace(prepend_scheme="never")
+    sentencepiece.decoder = decoders.Sequence([decoders.Replace("▁", " "), decoders.Fuse(), decoders.Strip(" ", 1, 0)])
+    corpus = ["the movie was great, the acting was wonderful", "label: 1, label: 12, label: positive", "transfer money to my account 1234567"] * 10
+    alphabet = list(string.ascii_letters + string.digits + string.punctuation + "\n▁")
+    sentencepiece.train_from_iterator(corpus, trainer=trainers.BpeTrainer(vocab_size=200, special_tokens=["<unk>"], initial_alphabet=alphabet))
+    return [byte_level, PreTrainedTokenizerFast(tokenizer_object=sentencepiece, unk_token="<unk>")]
+
+
+@pytest.mark.parametrize("prompt", ["Text: the acting was superb\nLabel:", "Text: transfer money to my account 1234567\nLabel:"])
+@pytest.mark.parametrize("continuation", [" 1", " 12", " positive"])
+def test_continuation_ids_real_tokenizers(prompt, continuation):
+    pytest.importorskip("tokenizers")
+    for tokenizer in get_real_tokenizers():
+        prompt_ids = tokenizer(prompt, add_special_tokens=False)["input_ids"]
+        full_ids = tokenizer(prompt + continuation, add_special_tokens=False)["input_ids"]
+        # the continuation does not merge with the prompt here, so it is tokenized as in the full text
+        assert full_ids[:len(prompt_ids)] == prompt_ids
+        assert get_continuation_ids(tokenizer, torch.tensor(prompt_ids), continuation) == full_ids[len(prompt_ids):]
+
+
+@pytest.mark.parametrize("attn_implementation", ["eager", "sdpa"])
+def test_packed_scoring_matches_separate_passes(attn_implementation):
+    pytest.importorskip("tokenizers")
+    from transformers import BatchEncoding, LlamaConfig, LlamaForCausalLM
+    from model_utils import HFModel
+
+    tokenizer = get_real_tokenizers()[1]
+    torch.manual_seed(0)
+    config = LlamaConfig(vocab_size=len(tokenizer), hidden_size=32, intermediate_size=64, num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=2)
+    config._attn_implementation = attn_implementation
+    # a tiny random model in place of the pretrained one, the other attributes are the ones that score_candidates uses
+    model = HFModel.__new__(HFModel)
+    model.model = LlamaForCausalLM(config).eval()
+    model.tokenizer = tokenizer
+    model.stop_token_ids = [tokenizer.convert_tokens_to_ids("\n")]
+    model.prefill_chunk_size = None
+    model.disable_prefill = False
+
+    input_ids = torch.tensor([tokenizer("Text: the acting was superb\nLabel:")["input_ids"]])
+    inputs = BatchEncoding({"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)})
+    candidates = [" 1", " 12", " positive", " great"]
+    output = model.score_candidates(inputs, candidates)
+
+    for candidate, score in zip(candidates, output["candidate_logprobs"]):
+        ids = get_continuation_ids(tokenizer, input_ids[0], candidate)
+        with torch.no_grad():
+            logits = model.model(input_ids=torch.cat([input_ids, torch.tensor([ids])], dim=1)).logits[0, -len(ids)-1:]
+        assert score == pytest.approx(get_candidate_score(torch.log_softmax(logits.float(), dim=-1), ids, model.stop_token_ids), abs=1e-4)
+    assert output["output"] == candidates[max(range(len(candidates)), key=lambda i: output["candidate_logprobs"][i])]
@@ -0,0 +1,68 @@
+import os
+
+import pytest
+
+pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+pytest.importorskip("tokenizers")
+
+import model_utils
+from model_utils import HFModel
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def get_model(max_running, prefill_chunk_size):
+    from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+    tokenizer = PreTrainedTokenizerFast(tokenizer_file=os.path.join(ROOT, "claude.tokenizer.json"))
+    # HFModel sets a pad token if the tokenizer has none, the free slots are fed with it
+    tokenizer.pad_token = "<EOT>"
+    torch.manual_seed(0)
+    config = LlamaConfig(vocab_size=len(tokenizer), hidden_size=32, intermediate_size=64, num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=2)
+    config._attn_implementation = "sdpa"
+    # a tiny random model in place of the pretrained one, the other attributes are the ones that the continuous batching uses
+    model = HFModel.__new__(HFModel)
+    model.model = LlamaForCausalLM(config).eval()
+    model.tokenizer = tokenizer
+    model.stop_token_ids = [tokenizer.convert_tokens_to_ids("Ċ")]
+    model.generation_max_length = 12
+    model.generation_min_length = 0
+    model.do_sample = False
+    model.disable_prefill = False
+    model.max_running = max_running
+    model.prefill_chunk_size = prefill_chunk_size
+    return model
+
+
+def greedy(model, input_ids, max_new_tokens, stop_token_ids):
+    # the reference: one input at a time, the whole sequence is fed at every step
+    tokens = []
+    with torch.no_grad():
+        while len(tokens) < max_new_tokens:
+            token = model(input_ids=torch.cat([input_ids, torch.tensor([tokens], dtype=torch.long)], dim=1)).logits[0, -1].argmax().item()
+            tokens.append(token)
+            if token in stop_token_ids:
+                break
+    return tokens
+
+
+@pytest.mark.parametrize("slack", [256, 3])
+def test_continuous_batching_matches_greedy(monkeypatch, slack):
+    from transformers import BatchEncoding
+    # a small slack shifts the cache columns (SlotKVCache.compact) many times during the run
+    slot_cache = model_utils.SlotKVCache
+    monkeypatch.setattr(model_utils, "SlotKVCache", lambda *args, **kwargs: slot_cache(*args, **{**kwargs, "slack": slack}))
+    model = get_model(max_running=3, prefill_chunk_size=4)
+    prompts = ["Question: what is the capital of France?\nAnswer:", "Hi", "Translate to German: the book is on the table, next to the cup of coffee.", "1, 2, 3, 4,", "A"]
+    inputs = []
+    for prompt in prompts:
+        input_ids = torch.tensor([model.tokenizer(prompt)["input_ids"]])
+        inputs.append(BatchEncoding({"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}))
+
+    outputs = dict(model.generate_continuous(inputs))
+    assert sorted(outputs) == list(range(len(prompts)))
+    for idx, x in enumerate(inputs):
+        tokens = greedy(model.model, x.input_ids, model.generation_max_length, model.stop_token_ids)
+        assert outputs[idx]["output_len"] == len(tokens)
+        assert outputs[idx]["output"] == model.tokenizer.decode(tokens, skip_special_tokens=True)
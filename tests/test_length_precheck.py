@@ -0,0 +1,74 @@
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+import model_utils
+from model_utils import LengthPrecheck
+
+
+def count_tokens(text):
+    # a fake tokenizer: 4 bytes per token for prose, one token per digit and two per multi-byte character
+    prose = "".join(c for c in text if c.isascii() and not c.isdigit())
+    return len(prose) // 4 + sum(1 for c in text if c.isdigit()) + 2 * sum(1 for c in text if not c.isascii())
+
+
+@pytest.fixture
+def precheck(tmp_path, monkeypatch):
+    monkeypatch.setattr(model_utils, "CACHE_DIR", str(tmp_path))
+    precheck = LengthPrecheck("fake", calibration_size=4)
+    prose = "the quick brown fox jumps over the lazy dog " * 100
+    for _ in range(4):
+        assert not precheck.is_under_budget("qa", prose, 1000)
+        precheck.update("qa", prose, count_tokens(prose))
+    return precheck
+
+
+def test_prose_skips_tokenization(precheck):
+    prose = "the quick brown fox jumps over the lazy dog " * 40
+    assert count_tokens(prose) <= 1000
+    assert precheck.is_under_budget("qa", prose, 1000)
+
+
+@pytest.mark.parametrize("outlier", ["1234567890 " * 150, "数据集" * 200])
+def test_outlier_is_still_truncated(precheck, outlier):
+    # even with the 2x margin, the calibrated 4 bytes per token puts these prompts under the budget, but they are not
+    assert len(outlier.encode("utf-8")) / 4 * 2 <= 1000
+    assert count_tokens(outlier) > 1000
+    assert not precheck.is_under_budget("qa", outlier, 1000)
+
+
+def test_hard_bound_without_calibration(tmp_path, monkeypatch):
+    monkeypatch.setattr(model_utils, "CACHE_DIR", str(tmp_path))
+    precheck = LengthPrecheck("fake")
+    assert precheck.is_under_budget(None, "数据集" * 100, 1000)
+    assert not precheck.is_under_budget(None, "数据集" * 400, 1000)
+
+
+def test_calibration_is_reloaded_and_lowered(precheck):
+    reloaded = LengthPrecheck("fake", calibration_size=4)
+    assert reloaded.get_calibration("qa") == precheck.get_calibration("qa")
+    # a prose prompt with far more tokens than the calibration allows for lowers the saved ratio
+    prose = "the quick brown fox jumps over the lazy dog " * 40
+    reloaded.update("qa", prose, len(prose))
+    assert LengthPrecheck("fake", calibration_size=4).get_calibration("qa")["bytes_per_token"] == pytest.approx(1.0)
+
+
+def test_worker_stats_are_merged(tmp_path, monkeypatch, caplog):
+    monkeypatch.setattr(model_utils, "CACHE_DIR", str(tmp_path))
+    main = LengthPrecheck("fake", calibration_size=4)
+    prose = "the quick brown fox jumps over the lazy dog " * 100
+    # two forked workers, each sees two prompts of the calibration and pops its stats with the chunk
+    workers = [LengthPrecheck("fake", calibration_size=4) for _ in range(2)]
+    for worker in workers:
+        for _ in range(2):
+            assert not worker.is_under_budget("qa", prose, 1000)
+            worker.update("qa", prose, count_tokens(prose))
+        main.merge_stats(worker.pop_stats())
+    assert main.get_calibration("qa")["samples"] == 4
+    with caplog.at_level("INFO", logger="model_utils"):
+        main.log_stats()
+    assert "skipped the exact tokenization for 0/4 prompts" in caplog.text
+    # the counts are only logged once
+    assert main.pop_stats()["checked"] == {}
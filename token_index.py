@@ -0,0 +1,123 @@
+"""
+Persistent index of the token offsets of long documents, so that each document is tokenized only once per tokenizer.
+The (start, end) character offsets of every token are stored as an int32 numpy array under $HELMET_CACHE_DIR/token_offsets/<tokenizer>/<document hash>.npy,
+and loaded memory-mapped. Truncating a document to any number of tokens is then a lookup in the array and a string slice,
+e.g., the same book evaluated at 8k to 128k, or the same book shared by several questions.
+Only the fast (Rust) tokenizers are supported, since the offsets come from their encodings.
+The modification time of an index file marks its last use, and evict_token_index removes the old and least recently used ones (eval.py runs it at the start).
+"""
+
+import os
+import time
+import shutil
+import hashlib
+import logging
+
+import numpy as np
+
+CACHE_DIR = os.getenv("HELMET_CACHE_DIR", os.path.expanduser("~/.cache/helmet"))
+INDEX_DIR = os.path.join(CACHE_DIR, "token_offsets")
+
+logger = logging.getLogger(__name__)
+
+# the tokenizer key is cached by the id of the tokenizer object, since serializing the tokenizer is slow
+tokenizer_keys = {}
+
+
+def get_tokenizer_key(tokenizer):
+    # the name alone is not enough, different versions of the same tokenizer can tokenize differently
+    if id(tokenizer) not in tokenizer_keys:
+        name = os.path.basename(str(tokenizer.name_or_path).rstrip("/"))
+        h = hashlib.sha256(tokenizer.backend_tokenizer.to_str().encode("utf-8")).hexdigest()[:16]
+        tokenizer_keys[id(tokenizer)] = f"{name}_{h}"
+    return tokenizer_keys[id(tokenizer)]
+
+
+def get_index_path(tokenizer, text, add_special_tokens=True):
+    text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    return os.path.join(INDEX_DIR, get_tokenizer_key(tokenizer), f"{text_hash}_special{int(add_special_tokens)}.npy")
+
+
+def load_offsets(path):
+    offsets = np.load(path, mmap_mode="r")
+    # empty files cannot be memory-mapped
+    return offsets if offsets.size > 0 else np.load(path)
+
+
+def touch(path):
+    try:
+        os.utime(path)
+    except OSError:
+        # evicted by another run in the meantime
+        pass
+
+
+def evict_entries(entries, max_size_gb=None, max_age_days=None, name="cache"):
+    """
+    entries is a list of (last use time, size in bytes, path), remove the entries that were not used for max_age_days,
+    and then the least recently used ones until the total size fits in max_size_gb.
+    """
+    entries = sorted(entries)
+    total_size = sum([e[1] for e in entries])
+    for mtime, size, entry in entries:
+        too_old = max_age_days is not None and time.time() - mtime > max_age_days * 86400
+        too_large = max_size_gb is not None and total_size > max_size_gb * 1024**3
+        if not too_old and not too_large:
+            continue
+        logger.info(f"Evicting {entry} from the {name}")
+        if os.path.isdir(entry):
+            shutil.rmtree(entry, ignore_errors=True)
+        elif os.path.exists(entry):
+            os.remove(entry)
+        total_size -= size
+
+
+def evict_token_index(max_size_gb=None, max_age_days=None, index_dir=INDEX_DIR):
+    if not os.path.exists(index_dir):
+        return
+    entries = []
+    for root, _, files in os.walk(index_dir):
+        for f in files:
+            path = os.path.join(root, f)
+            try:
+                entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+            except OSError:
+                continue
+    evict_entries(entries, max_size_gb=max_size_gb, max_age_days=max_age_days, name="token index")
+
+
+def build_token_offsets(tokenizer, texts, add_special_tokens=True, batch_size=32):
+    """
+    Make sure that the offsets of all the texts are indexed, and return the paths to the index files (see load_offsets).
+    The texts that are not indexed yet are encoded in batches, which the fast tokenizers run in parallel.
+    The paths are returned instead of the arrays, so that the callers do not keep thousands of files open.
+    """
+    paths = [get_index_path(tokenizer, text, add_special_tokens) for text in texts]
+    missing = {}
+    for text, path in zip(texts, paths):
+        if not os.path.exists(path):
+            missing[path] = text
+        else:
+            touch(path)
+    if len(missing) == 0:
+        return paths
+
+    os.makedirs(os.path.dirname(paths[0]), exist_ok=True)
+    missing = list(missing.items())
+    for start in range(0, len(missing), batch_size):
+        batch = missing[start:start+batch_size]
+        encodings = tokenizer.backend_tokenizer.encode_batch([text for _, text in batch], add_special_tokens=add_special_tokens)
+        for (path, _), encoding in zip(batch, encodings):
+            offsets = np.array(encoding.offsets, dtype=np.int32).reshape(-1, 2)
+            # write to a temporary file first so that the concurrent runs never read a partial index
+            tmp_path = path + f".tmp{os.getpid()}.npy"
+            np.save(tmp_path, offsets)
+            os.replace(tmp_path, path)
+    return paths
+
+
+def get_token_offsets(tokenizer, text, add_special_tokens=True):
+    """
+    Get the (start, end) character offsets of the tokens of the text, as a (num_tokens, 2) array.
+    """
+    return load_offsets(build_token_offsets(tokenizer, [text], add_special_tokens)[0])
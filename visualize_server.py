@@ -12,6 +12,8 @@ from pathlib import Path
 from collections import defaultdict
 import re
 
+from result_io import load_results
+
 app = Flask(__name__)
 
 # 数据集到指标的映射
@@ -217,8 +219,7 @@ def load_case_data(model_name, filename, base_path='output'):
         return None
     
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            raw_data = json.load(f)
+        raw_data = load_results(filepath)
         
         meta = raw_data.get('args', {})
         